@@ -0,0 +1,504 @@
+# Нагрузочные прогоны GVF бота без Telegram.
+#
+#   DATABASE_URL=postgres://localhost/gvf_bench python bench.py load --users 200 --duration 60
+#   DATABASE_URL=postgres://localhost/gvf_snap python bench.py replay lunch.jsonl.gz --speed 10 --profile lunch.prof
+#
+# Bot API подменяется FakeTelegram-сессией прямо в процессе, апдейты идут
+# в Dispatcher.feed_update — весь путь бота (middleware, FSM, пул,
+# outbound-лимитер) работает как в проде. База настоящая: бери отдельную.
+#
+# load   — синтетические юзеры (онбординг, лента, публикация, take, рассылка);
+#          --cleanup удалит их в конце.
+# replay — апдейты, записанные ботом с UPDATE_RECORD_PATH, в исходном темпе
+#          (--speed 1), ускоренно (--speed 10) или без пауз (--speed 0).
+#          База должна быть снимком прода на момент записи, иначе хендлеры
+#          не найдут юзеров и объявления. --profile / --tracemalloc снимают
+#          профиль каждого прогона (--runs).
+#
+# --json сохраняет результат, --compare сверяет p95 с сохранённым прогоном
+# и завершается с кодом 1, если что-то стало медленнее --tolerance.
+
+import argparse
+import asyncio
+import cProfile
+import gzip
+import itertools
+import json
+import os
+import random
+import pstats
+import sys
+import time
+import tracemalloc
+from collections import Counter, defaultdict, deque
+from typing import Any, Optional, Union
+
+# до импорта bot: лимиты Telegram не нужны, если не просили --real-limits
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["UPDATE_RECORD_PATH"] = ""
+
+BENCH_USER_BASE = 9_000_000_000
+
+
+def parse_args() -> argparse.Namespace:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--api-latency", type=float, default=0.05, help="fake Bot API latency, sec")
+    common.add_argument("--real-limits", action="store_true", help="keep TG_* and THROTTLE_* limits from env")
+    common.add_argument("--json", help="write results to this file")
+    common.add_argument("--compare", help="previous --json result to compare p95 against")
+    common.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown for --compare")
+
+    p = argparse.ArgumentParser(description="GVF bot load tests against a fake Bot API")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    load = sub.add_parser("load", parents=[common], help="synthetic users")
+    load.add_argument("--users", type=int, default=100, help="concurrent synthetic users")
+    load.add_argument("--duration", type=float, default=30, help="seconds of load after onboarding")
+    load.add_argument("--think", type=float, default=0.5, help="mean pause between user actions, sec")
+    load.add_argument("--seed-ads", type=int, default=200, help="ads published before the load starts")
+    load.add_argument("--broadcast", action="store_true", help="admin starts a broadcast mid-run")
+    load.add_argument("--cleanup", action="store_true", help="delete bench users and their ads afterwards")
+    load.add_argument("--seed", type=int, default=1)
+
+    replay = sub.add_parser("replay", parents=[common], help="updates recorded with UPDATE_RECORD_PATH")
+    replay.add_argument("file", help="*.jsonl.gz written by the bot")
+    replay.add_argument("--speed", type=float, default=1.0, help="1 — as recorded, 10 — 10x faster, 0 — no pauses")
+    replay.add_argument("--concurrency", type=int, default=100, help="max updates in flight")
+    replay.add_argument("--runs", type=int, default=1, help="replay the file this many times")
+    replay.add_argument("--profile", help="cProfile output; with --runs N saved as <path>.N")
+    replay.add_argument("--tracemalloc", type=int, default=0, metavar="FRAMES",
+                        help="trace allocations and print top growth per run")
+    replay.add_argument("--snapshot-dir", help="also dump tracemalloc snapshots here")
+    return p.parse_args()
+
+
+args = parse_args()
+if not args.real_limits:
+    os.environ.setdefault("TG_GLOBAL_RATE", "100000")
+    os.environ.setdefault("TG_CHAT_RATE", "1000")
+    os.environ.setdefault("TG_CHAT_BURST", "1000")
+    os.environ.setdefault("THROTTLE_RATE", "0")
+
+import bot as gvf  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+
+# ================= FAKE BOT API =================
+
+class FakeTelegram(BaseSession):
+    # отвечает на методы Bot API так, как ответил бы Telegram, и помнит
+    # последние сообщения с инлайн-кнопками в каждом чате — по ним юзеры «кликают»
+    EDITS = {"editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup"}
+    SENDS = {"sendMessage", "sendPhoto"}
+
+    def __init__(self, latency: float) -> None:
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self.screens: dict[int, deque[dict[str, Any]]] = defaultdict(lambda: deque(maxlen=5))
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: Any, timeout: Optional[int] = None) -> Any:
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        name = method.__api_method__
+        self.calls[name] += 1
+        result = self._answer(bot, name, method)
+        response = self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result}))
+        return response.result
+
+    def _answer(self, bot: Bot, name: str, method: Any) -> Any:
+        if name == "getMe":
+            return {"id": bot.id, "is_bot": True, "first_name": "bench"}
+        if name not in self.SENDS and name not in self.EDITS:
+            return True
+
+        chat_id = int(method.chat_id)
+        msg: dict[str, Any] = {
+            "message_id": method.message_id if name in self.EDITS else next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        media = getattr(method, "media", None)
+        photo = getattr(method, "photo", None) or getattr(media, "media", None)
+        if photo:
+            msg["photo"] = [{"file_id": str(photo), "file_unique_id": str(photo), "width": 1, "height": 1}]
+            msg["caption"] = getattr(method, "caption", None) or getattr(media, "caption", None) or ""
+        else:
+            msg["text"] = getattr(method, "text", None) or ""
+        markup = getattr(method, "reply_markup", None)
+        if markup is not None and hasattr(markup, "inline_keyboard"):
+            msg["reply_markup"] = markup.model_dump(exclude_none=True)
+            screens = self.screens[chat_id]
+            if name in self.EDITS:
+                for i, old in enumerate(screens):
+                    if old["message_id"] == msg["message_id"]:
+                        del screens[i]
+                        break
+            screens.append(msg)
+        return msg
+
+    def find(self, chat_id: int, prefix: Union[str, tuple[str, ...]]) -> Optional[tuple[dict[str, Any], str]]:
+        # свежайший экран с кнопкой, чей callback_data начинается с prefix
+        for msg in reversed(self.screens.get(chat_id, ())):
+            for row in msg["reply_markup"]["inline_keyboard"]:
+                for btn in row:
+                    data = btn.get("callback_data") or ""
+                    if data.startswith(prefix):
+                        return msg, data
+        return None
+
+    async def stream_content(self, *args: Any, **kwargs: Any):  # type: ignore[override]
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+# ================= SYNTHETIC USERS =================
+
+class Recorder:
+    def __init__(self) -> None:
+        self.samples: dict[str, list[float]] = defaultdict(list)
+        self.errors: Counter[str] = Counter()
+        self.updates = 0
+
+    def report(self, elapsed: float) -> dict[str, Any]:
+        actions = {}
+        for action, xs in sorted(self.samples.items()):
+            xs.sort()
+            actions[action] = {
+                "count": len(xs),
+                "p50_ms": _pct(xs, 0.50) * 1000,
+                "p95_ms": _pct(xs, 0.95) * 1000,
+                "p99_ms": _pct(xs, 0.99) * 1000,
+            }
+        return {
+            "updates": self.updates,
+            "elapsed_sec": elapsed,
+            "throughput_rps": self.updates / elapsed if elapsed else 0.0,
+            "actions": actions,
+            "errors": dict(self.errors),
+        }
+
+
+def _pct(xs: list[float], q: float) -> float:
+    if not xs:
+        return 0.0
+    return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+class Harness:
+    def __init__(self, bot: Bot, dp: Any, api: FakeTelegram) -> None:
+        self.bot = bot
+        self.dp = dp
+        self.api = api
+        self.rec = Recorder()
+        self._update_ids = itertools.count(1)
+        self._ids = itertools.count(1)
+
+    def _user(self, uid: int) -> dict[str, Any]:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"bench{uid}"}
+
+    async def _feed(self, action: str, payload: dict[str, Any]) -> None:
+        update = Update.model_validate({"update_id": next(self._update_ids), **payload}, context={"bot": self.bot})
+        await self.feed_update(action, update)
+
+    async def feed_update(self, action: str, update: Update) -> None:
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.rec.errors[f"{action}: {type(e).__name__}"] += 1
+        self.rec.samples[action].append(time.perf_counter() - started)
+        self.rec.updates += 1
+
+    async def message(self, uid: int, action: str, **fields: Any) -> None:
+        await self._feed(action, {
+            "message": {
+                "message_id": next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": self._user(uid),
+                **fields,
+            }
+        })
+
+    async def click(self, uid: int, prefix: Union[str, tuple[str, ...]], action: Optional[str] = None) -> bool:
+        found = self.api.find(uid, prefix)
+        if found is None:
+            return False
+        msg, data = found
+        await self._feed(action or prefix.rstrip(":"), {
+            "callback_query": {
+                "id": str(next(self._ids)),
+                "from": self._user(uid),
+                "chat_instance": str(uid),
+                "message": msg,
+                "data": data,
+            }
+        })
+        return True
+
+    # --- сценарии ---
+
+    async def onboard(self, uid: int) -> None:
+        await self.message(uid, "start", text="/start")
+        await self.click(uid, "start_go")
+        await self.message(uid, "contact", contact={
+            "phone_number": f"+7{uid % 10**10:010d}",
+            "first_name": f"u{uid}",
+            "user_id": uid,
+        })
+
+    async def browse(self, uid: int, rng: random.Random) -> None:
+        if not await self.click(uid, "menu_food"):
+            return
+        if not await self.click(uid, "food_view"):
+            return
+        for _ in range(rng.randint(3, 15)):
+            # стрелки обычной ленты или ленты по общаге — что показал бот
+            if rng.random() < 0.2:
+                found = await self.click(uid, ("food_prev", "food_rprev"), "feed_prev")
+            else:
+                found = await self.click(uid, ("food_next", "food_rnext"), "feed_next")
+            if not found:
+                return
+            if rng.random() < 0.05:
+                await self.click(uid, "food_take:")
+                return
+        await self.click(uid, "menu_home")
+
+    async def publish(self, uid: int, rng: random.Random) -> None:
+        if not await self.click(uid, "menu_food") or not await self.click(uid, "food_add"):
+            return
+        photo = f"bench-photo-{rng.randrange(10**6)}"
+        await self.message(uid, "add_photo", photo=[
+            {"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1},
+        ])
+        await self.message(uid, "add_price", text=str(rng.randrange(50, 500, 10)))
+        await self.message(uid, "add_description", text="Бенч-еда, " + rng.choice(["плов", "суп", "пицца", "пельмени"]))
+        await self.message(uid, "add_dorm", text=str(rng.randint(1, 12)))
+        await self.message(uid, "add_location", text="на тумбе")
+        await self.click(uid, "food_publish")
+
+    async def my_ads(self, uid: int, rng: random.Random) -> None:
+        await self.click(uid, "menu_home")
+        if not await self.click(uid, "menu_my"):
+            return
+        for _ in range(rng.randint(1, 5)):
+            if not await self.click(uid, "my_next"):
+                return
+
+    async def broadcast(self, admin_id: int) -> None:
+        await self.message(admin_id, "admin", text="/admin")
+        await self.click(admin_id, "admin_broadcast")
+        await self.message(admin_id, "broadcast_text", text="Бенч-рассылка")
+        await self.click(admin_id, "admin_send")
+
+    async def user_loop(self, uid: int, deadline: float, think: float) -> None:
+        rng = random.Random(uid)
+        scenarios = [self.browse, self.publish, self.my_ads]
+        weights = [80, 5, 15]
+        while time.monotonic() < deadline:
+            await asyncio.sleep(rng.expovariate(1 / think) if think else 0)
+            await rng.choices(scenarios, weights)[0](uid, rng)
+            if not self.api.find(uid, "menu_food"):
+                # экран потерялся (например, после take) — как юзер, жмём /start
+                await self.message(uid, "start", text="/start")
+
+
+# ================= RUN =================
+
+def print_report(result: dict[str, Any], api: FakeTelegram) -> None:
+    print(f"\nupdates: {result['updates']}  elapsed: {result['elapsed_sec']:.1f}s  "
+          f"throughput: {result['throughput_rps']:.1f} upd/s")
+    print(f"\n{'action':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for action, a in result["actions"].items():
+        print(f"{action:<18}{a['count']:>8}{a['p50_ms']:>10.1f}{a['p95_ms']:>10.1f}{a['p99_ms']:>10.1f}")
+    if result["errors"]:
+        print("\nerrors:")
+        for k, n in result["errors"].items():
+            print(f"  {k}: {n}")
+    print("\nBot API calls:", dict(api.calls.most_common()))
+    print("DB pool:", result["pool"])
+    print("slowest queries (total ms):")
+    for q, total in result["db_queries_ms"][:8]:
+        print(f"  {q}: {total:.0f}")
+
+
+def compare(result: dict[str, Any], path: str, tolerance: float) -> list[str]:
+    with open(path) as f:
+        base = json.load(f)
+    slower = []
+    for action, a in result["actions"].items():
+        old = base["actions"].get(action)
+        if old and old["p95_ms"] > 0 and a["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            slower.append(f"{action}: p95 {old['p95_ms']:.1f} → {a['p95_ms']:.1f} ms")
+    return slower
+
+
+def finish(result: dict[str, Any], api: FakeTelegram) -> int:
+    result["pool"] = gvf.pool_stats()
+    result["db_queries_ms"] = sorted(
+        ((q, total * 1000) for q, total in gvf._db_query_seconds.sums.items()),
+        key=lambda kv: -kv[1],
+    )
+    result["telegram_calls"] = dict(api.calls)
+    print_report(result, api)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        slower = compare(result, args.compare, args.tolerance)
+        if slower:
+            print("\nREGRESSION:")
+            for line in slower:
+                print("  " + line)
+            return 1
+    return 0
+
+
+async def run_load(h: Harness) -> int:
+    uids = [BENCH_USER_BASE + i for i in range(args.users)]
+    try:
+        # онбординг и стартовые объявления — не в зачёт
+        await asyncio.gather(*(h.onboard(uid) for uid in uids))
+        seed_rng = random.Random(args.seed)
+        for i in range(args.seed_ads):
+            await h.publish(uids[i % len(uids)], seed_rng)
+        warmup = h.rec
+        h.rec = Recorder()
+        h.rec.errors.update(warmup.errors)
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        tasks = [h.user_loop(uid, deadline, args.think) for uid in uids]
+        if args.broadcast:
+            async def delayed_broadcast() -> None:
+                await asyncio.sleep(args.duration / 2)
+                await h.onboard(gvf.ADMIN_ID)
+                await h.broadcast(gvf.ADMIN_ID)
+            tasks.append(delayed_broadcast())
+        await asyncio.gather(*tasks)
+        return finish(h.rec.report(time.monotonic() - started), h.api)
+    finally:
+        if args.cleanup:
+            await gvf.db_pool().execute(
+                "DELETE FROM users WHERE user_id >= $1 AND user_id < $2",
+                BENCH_USER_BASE,
+                BENCH_USER_BASE + args.users,
+            )
+
+
+def load_recording(path: str) -> list[tuple[float, dict[str, Any]]]:
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                records.append((r["t"], r["update"]))
+    records.sort(key=lambda r: r[0])
+    return records
+
+
+def replay_action(update: Update) -> str:
+    if update.callback_query is not None:
+        return "cb:" + (update.callback_query.data or "").split(":")[0]
+    if update.message is not None:
+        m = update.message
+        if m.text and m.text.startswith("/"):
+            return "cmd:" + m.text.split()[0]
+        return "msg:" + m.content_type
+    return update.event_type
+
+
+async def replay_once(h: Harness, records: list[tuple[float, dict[str, Any]]]) -> float:
+    # паузы — по исходным меткам времени, делённым на --speed; апдейты
+    # обрабатываются параллельно, как в polling/webhook
+    sem = asyncio.Semaphore(args.concurrency)
+    tasks: list[asyncio.Task] = []
+
+    async def one(update: Update) -> None:
+        try:
+            await h.feed_update(replay_action(update), update)
+        finally:
+            sem.release()
+
+    t0 = records[0][0]
+    started = time.monotonic()
+    for t, raw in records:
+        if args.speed > 0:
+            delay = (t - t0) / args.speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await sem.acquire()
+        update = Update.model_validate(raw, context={"bot": h.bot})
+        tasks.append(asyncio.create_task(one(update)))
+    await asyncio.gather(*tasks)
+    return time.monotonic() - started
+
+
+async def run_replay(h: Harness) -> int:
+    records = load_recording(args.file)
+    if not records:
+        print(f"{args.file}: no updates")
+        return 1
+    span = records[-1][0] - records[0][0]
+    print(f"{args.file}: {len(records)} updates over {span:.0f}s, speed {args.speed or 'max'}")
+
+    code = 0
+    for n in range(1, args.runs + 1):
+        h.rec = Recorder()
+        profiler = cProfile.Profile() if args.profile else None
+        if args.tracemalloc:
+            tracemalloc.start(args.tracemalloc)
+            before = tracemalloc.take_snapshot()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            elapsed = await replay_once(h, records)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+        print(f"\n=== run {n}/{args.runs} ===")
+        if profiler is not None:
+            path = f"{args.profile}.{n}" if args.runs > 1 else args.profile
+            profiler.dump_stats(path)
+            print(f"cProfile saved to {path}, top by cumulative time:")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+        if args.tracemalloc:
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            print("tracemalloc, top growth:")
+            for stat in after.compare_to(before, "lineno")[:15]:
+                print(f"  {stat}")
+            if args.snapshot_dir:
+                os.makedirs(args.snapshot_dir, exist_ok=True)
+                after.dump(os.path.join(args.snapshot_dir, f"run{n}.snap"))
+        code |= finish(h.rec.report(elapsed), h.api)
+    return code
+
+
+async def run() -> int:
+    api = FakeTelegram(args.api_latency)
+    bot = Bot(gvf.BOT_TOKEN, session=api)
+    dp = gvf.create_dispatcher(bot)
+    await gvf.start_background(bot, dp)
+    h = Harness(bot, dp, api)
+    try:
+        if args.cmd == "replay":
+            return await run_replay(h)
+        return await run_load(h)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await gvf.db_pool().close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run()))
@@ -1,23 +1,43 @@
 import asyncio
+import gzip
+import json
 import logging
 import os
-from typing import Optional
+import heapq
+import hmac
+import re
+import secrets
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import cache
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Mapping, Optional, Union
 
 import asyncpg
-from aiogram import Bot, Dispatcher, F, Router
-from aiogram.filters import Command, CommandStart
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, CommandStart, Filter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.types import (
     InputMediaPhoto,
     CallbackQuery,
+    TelegramObject,
+    User,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
     Message,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
+    Update,
 )
 
 # ================= APP =================
@@ -32,6 +52,63 @@ logging.basicConfig(level=logging.INFO)
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip() or os.getenv("DATABASE_PUBLIC_URL", "").strip()
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "10"))
+# 0 — для pgbouncer в transaction-режиме: без prepared statements вообще
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+# неверифицированные и отсутствующие: верификация на соседней реплике должна
+# стать видна почти сразу
+USER_CACHE_UNVERIFIED_TTL = float(os.getenv("USER_CACHE_UNVERIFIED_TTL", "5"))
+FEED_SIZE = int(os.getenv("FEED_SIZE", "50"))
+FEED_RECONCILE_SEC = float(os.getenv("FEED_RECONCILE_SEC", "60"))
+NAV_DEBOUNCE_SEC = float(os.getenv("NAV_DEBOUNCE_SEC", "0.15"))  # окно склейки нажатий ⬅️/➡️
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # msg/sec, Telegram allows ~30
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "100"))
+BROADCAST_LEASE_SEC = int(os.getenv("BROADCAST_LEASE_SEC", "60"))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+FSM_TTL_SEC = int(os.getenv("FSM_TTL_SEC", str(24 * 3600)))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "5000"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "5"))
+FSM_FLUSH_SEC = float(os.getenv("FSM_FLUSH_SEC", "1"))
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()  # public base url, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+STATS_FLUSH_SEC = float(os.getenv("STATS_FLUSH_SEC", "10"))
+FOOD_TTL_HOURS = float(os.getenv("FOOD_TTL_HOURS", "12"))
+MARKET_TTL_DAYS = float(os.getenv("MARKET_TTL_DAYS", "30"))
+STUDY_TTL_DAYS = float(os.getenv("STUDY_TTL_DAYS", "14"))
+JANITOR_SEC = float(os.getenv("JANITOR_SEC", "60"))
+JANITOR_BATCH = int(os.getenv("JANITOR_BATCH", "200"))
+# токен-бакет на юзера: THROTTLE_RATE токенов/сек, запас THROTTLE_BURST; 0 — выключен
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "4"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "12"))
+THROTTLE_COST_NAV = float(os.getenv("THROTTLE_COST_NAV", "1"))  # листание
+THROTTLE_COST_DEFAULT = float(os.getenv("THROTTLE_COST_DEFAULT", "2"))  # меню, шаги анкет
+THROTTLE_COST_HEAVY = float(os.getenv("THROTTLE_COST_HEAVY", "6"))  # публикация, ❤️
+THROTTLE_MAX_WAIT = float(os.getenv("THROTTLE_MAX_WAIT", "2"))  # дольше ждать листание не станем
+ACTION_DEDUP_SEC = float(os.getenv("ACTION_DEDUP_SEC", "3"))  # повтор той же кнопки после завершения
+ACTION_KEY_TTL_HOURS = float(os.getenv("ACTION_KEY_TTL_HOURS", "24"))
+REVIEW_PAGE = int(os.getenv("REVIEW_PAGE", "5"))  # объявлений на странице модерации
+REVIEW_DIGEST_SEC = float(os.getenv("REVIEW_DIGEST_SEC", "900"))  # сводка админу о новых объявлениях
+RANK_REFRESH_SEC = float(os.getenv("RANK_REFRESH_SEC", "30"))
+RANK_RECENCY_HOURS = float(os.getenv("RANK_RECENCY_HOURS", "6"))  # +1 очко за каждые N часов свежести
+RANK_DORM_WEIGHT = float(os.getenv("RANK_DORM_WEIGHT", "4"))  # своя общага; соседняя — половина
+RANK_ENGAGEMENT_WEIGHT = float(os.getenv("RANK_ENGAGEMENT_WEIGHT", "1"))  # * ln(1 + views + 5*takes)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # отдельный listener для /metrics, 0 — выключен
+UPDATE_RECORD_PATH = os.getenv("UPDATE_RECORD_PATH", "").strip()  # *.jsonl.gz, пусто — не пишем
+UPDATE_RECORD_FLUSH_SEC = float(os.getenv("UPDATE_RECORD_FLUSH_SEC", "5"))
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is empty")
@@ -39,71 +116,558 @@ if not BOT_TOKEN:
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is empty")
 
-logging.info("[boot] APP_VERSION=%s", APP_VERSION)
-logging.info("[boot] ADMIN_ID=%s", ADMIN_ID)
-
-# ================= DB =================
-
-_pool: Optional[asyncpg.Pool] = None
+# без секрета любой, кто узнал URL, может прислать апдейт от имени ADMIN_ID
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET is empty (required with BOT_MODE=webhook)")
 
+if BOT_MODE == "webhook" and METRICS_PORT == WEBHOOK_PORT:
+    raise RuntimeError("METRICS_PORT must differ from PORT: /metrics is not served on the webhook listener")
 
-async def db_init() -> None:
-    global _pool
-    _pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+logging.info("[boot] APP_VERSION=%s", APP_VERSION)
+logging.info("[boot] ADMIN_ID=%s", ADMIN_ID)
 
-    async with _pool.acquire() as conn:
-        # users
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                phone TEXT,
-                is_verified BOOLEAN NOT NULL DEFAULT FALSE,
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            """
+# ================= METRICS =================
+# Всё считается в памяти процесса. /metrics отдаёт текстовый формат
+# Prometheus, /stats — короткую сводку админу.
+#   gvf_handler_seconds{handler}        — время хендлера (вместе с гейтами)
+#   gvf_db_query_seconds{query}         — время именованного запроса
+#   gvf_telegram_request_seconds{method} — каждый HTTP-вызов Bot API, включая ретраи
+#   gvf_swallowed_exceptions_total{site} — проглоченные `except Exception`
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str = "", buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.counts: dict[str, list[int]] = {}
+        self.sums: dict[str, float] = {}
+
+    def observe(self, seconds: float, value: str = "") -> None:
+        counts = self.counts.get(value)
+        if counts is None:
+            counts = self.counts[value] = [0] * (len(self.buckets) + 1)
+            self.sums[value] = 0.0
+        counts[bisect_left(self.buckets, seconds)] += 1
+        self.sums[value] += seconds
+
+    def count(self, value: str = "") -> int:
+        return sum(self.counts.get(value, ()))
+
+    def quantile(self, q: float, value: str = "") -> float:
+        # верхняя граница бакета, в который попадает квантиль
+        counts = self.counts.get(value)
+        if not counts:
+            return 0.0
+        rank = q * sum(counts)
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[min(i, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, counts in sorted(self.counts.items()):
+            sel = f'{self.label}="{_label(value)}",' if self.label else ""
+            acc = 0
+            for le, c in zip([*map(str, self.buckets), "+Inf"], counts):
+                acc += c
+                lines.append(f'{self.name}_bucket{{{sel}le="{le}"}} {acc}')
+            sel = sel.rstrip(",")
+            sel = f"{{{sel}}}" if sel else ""
+            lines.append(f"{self.name}_sum{sel} {self.sums[value]:.6f}")
+            lines.append(f"{self.name}_count{sel} {acc}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], int] = {}
+
+    def inc(self, *values: str, n: int = 1) -> None:
+        self.values[values] = self.values.get(values, 0) + n
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, n in sorted(self.values.items()):
+            sel = ",".join(f'{k}="{_label(v)}"' for k, v in zip(self.labels, values))
+            lines.append(f"{self.name}{{{sel}}} {n}" if sel else f"{self.name} {n}")
+        return lines
+
+
+METRICS: list[Any] = []
+# (name, help, fn, type): значение снимается при отдаче /metrics
+GAUGES: list[tuple[str, str, Callable[[], Optional[float]], str]] = []
+
+
+def metric(m: Any) -> Any:
+    METRICS.append(m)
+    return m
+
+
+def gauge(name: str, help: str, fn: Callable[[], Optional[float]]) -> None:
+    GAUGES.append((name, help, fn, "gauge"))
+
+
+def counter_fn(name: str, help: str, fn: Callable[[], Optional[float]]) -> None:
+    # монотонный счётчик, который уже ведёт кто-то другой (name — *_total)
+    GAUGES.append((name, help, fn, "counter"))
+
+
+def render_metrics() -> str:
+    lines: list[str] = []
+    for m in METRICS:
+        lines += m.render()
+    for name, help, fn, kind in GAUGES:
+        try:
+            value = fn()
+        except Exception:
+            # например, пул ещё не поднят
+            continue
+        if value is None:
+            continue
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+_handler_seconds = metric(Histogram("gvf_handler_seconds", "Update handler latency", "handler"))
+_handler_errors = metric(Counter("gvf_handler_errors_total", "Unhandled handler exceptions", ("handler",)))
+_db_query_seconds = metric(Histogram("gvf_db_query_seconds", "Named DB query latency", "query"))
+_db_pool_wait = metric(Histogram(
+    "gvf_db_pool_wait_seconds",
+    "Time waiting for a free pool connection",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0),
+))
+_tg_seconds = metric(Histogram("gvf_telegram_request_seconds", "Bot API request latency", "method"))
+_tg_errors = metric(Counter("gvf_telegram_errors_total", "Bot API errors", ("method", "kind")))
+_swallowed = metric(Counter("gvf_swallowed_exceptions_total", "Exceptions caught and ignored", ("site",)))
+_throttled = metric(Counter("gvf_throttled_total", "Updates delayed or dropped by Throttle", ("group", "outcome")))
+_nav_coalesced = metric(Counter("gvf_nav_coalesced_total", "Arrow presses folded into another render"))
+_actions_dropped = metric(Counter("gvf_actions_dropped_total", "Duplicate presses dropped by ActionLock", ("handler",)))
+
+
+def swallowed(site: str) -> None:
+    # вместо голого `pass`: ошибка не важна для пользователя, но видна в метриках
+    _swallowed.inc(site)
+    logging.debug("[swallowed] %s", site, exc_info=True)
+
+# ================= MIGRATIONS =================
+# Версионированные миграции: (version, name, sql). Только дописывать в конец,
+# уже применённые не менять. Каждая выполняется в своей транзакции под
+# advisory lock, чтобы несколько реплик при деплое не мигрировали наперегонки.
+
+MIGRATIONS: list[tuple[int, str, str]] = [
+    (
+        1,
+        "baseline",
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            phone TEXT,
+            is_verified BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS ads (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            category TEXT NOT NULL,
+            photo_file_id TEXT,
+            price TEXT,
+            description TEXT,
+            dorm INTEGER,
+            location TEXT,
+            views INTEGER NOT NULL DEFAULT 0,
+            approved BOOLEAN NOT NULL DEFAULT TRUE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+
+        INSERT INTO settings(key, value)
+        VALUES ('tech_mode', 'false')
+        ON CONFLICT (key) DO NOTHING;
+        """,
+    ),
+    (
+        2,
+        "hot path indexes",
+        """
+        -- лента: category=... AND approved ORDER BY created_at DESC, id DESC (+ keyset)
+        CREATE INDEX IF NOT EXISTS ads_feed_idx
+            ON ads (category, created_at DESC, id DESC)
+            WHERE approved;
+
+        -- мои объявления (и каскадное удаление пользователя)
+        CREATE INDEX IF NOT EXISTS ads_user_created_idx
+            ON ads (user_id, created_at DESC, id DESC);
+
+        -- рассылка: index-only scan по подтверждённым
+        CREATE INDEX IF NOT EXISTS users_verified_idx
+            ON users (user_id)
+            WHERE is_verified;
+        """,
+    ),
+    (
+        3,
+        "broadcast jobs",
+        """
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN NOT NULL DEFAULT FALSE;
+
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id BIGINT,
+            progress_message_id BIGINT,
+            lease_until TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        );
+
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id BIGINT NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS broadcast_recipients_pending_idx
+            ON broadcast_recipients (broadcast_id, user_id)
+            WHERE status='pending';
+        """,
+    ),
+    (
+        4,
+        "fsm storage",
+        """
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE INDEX IF NOT EXISTS fsm_updated_idx ON fsm (updated_at);
+        """,
+    ),
+    (
+        5,
+        "engagement stats",
+        """
+        ALTER TABLE ads ADD COLUMN IF NOT EXISTS takes INTEGER NOT NULL DEFAULT 0;
+
+        CREATE TABLE IF NOT EXISTS ad_stats_daily (
+            day DATE NOT NULL,
+            ad_id BIGINT NOT NULL REFERENCES ads(id) ON DELETE CASCADE,
+            views INTEGER NOT NULL DEFAULT 0,
+            takes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, ad_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS ad_stats_daily_ad_idx ON ad_stats_daily (ad_id);
+
+        CREATE TABLE IF NOT EXISTS dorm_stats_daily (
+            day DATE NOT NULL,
+            dorm INTEGER NOT NULL,
+            views INTEGER NOT NULL DEFAULT 0,
+            takes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, dorm)
+        );
+        """,
+    ),
+    (
+        6,
+        "ads search",
+        r"""
+        -- location не индексируем: его видно только после ❤️
+        ALTER TABLE ads ADD COLUMN IF NOT EXISTS search tsvector
+            GENERATED ALWAYS AS (to_tsvector('russian', coalesce(description, ''))) STORED;
+
+        -- цена — свободный текст ("150", "100-200"); для фильтра берём первое число
+        ALTER TABLE ads ADD COLUMN IF NOT EXISTS price_num INTEGER
+            GENERATED ALWAYS AS (substring(price FROM '\d{1,9}')::integer) STORED;
+
+        CREATE INDEX IF NOT EXISTS ads_search_idx
+            ON ads USING GIN (search)
+            WHERE approved = TRUE;
+
+        CREATE INDEX IF NOT EXISTS ads_dorm_created_idx
+            ON ads (dorm, created_at DESC, id DESC)
+            WHERE approved = TRUE;
+        """,
+    ),
+    (
+        7,
+        "ranked feed",
+        """
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS dorm INTEGER;
+
+        -- общага зрителя: последняя, которую он указывал в объявлениях
+        UPDATE users u
+        SET dorm = (
+            SELECT a.dorm FROM ads a
+            WHERE a.user_id = u.user_id AND a.dorm IS NOT NULL
+            ORDER BY a.created_at DESC
+            LIMIT 1
         )
+        WHERE u.dorm IS NULL;
+
+        ALTER TABLE ads ADD COLUMN IF NOT EXISTS engaged_at TIMESTAMPTZ;
+
+        CREATE INDEX IF NOT EXISTS ads_engaged_idx
+            ON ads (engaged_at)
+            WHERE approved;
+
+        CREATE TABLE IF NOT EXISTS feed_rank (
+            viewer_dorm INTEGER NOT NULL,
+            ad_id BIGINT NOT NULL REFERENCES ads(id) ON DELETE CASCADE,
+            score BIGINT NOT NULL,
+            PRIMARY KEY (viewer_dorm, ad_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS feed_rank_order_idx
+            ON feed_rank (viewer_dorm, score DESC, ad_id DESC);
+
+        CREATE INDEX IF NOT EXISTS feed_rank_ad_idx ON feed_rank (ad_id);
+        """,
+    ),
+    (
+        8,
+        "ad expiry",
+        """
+        ALTER TABLE ads ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ;
+
+        -- старые объявления — по умолчаниям FOOD_TTL_HOURS / MARKET_TTL_DAYS,
+        -- зашитым в миграцию: переменные окружения на бэкфилл не влияют
+        UPDATE ads SET expires_at = created_at + INTERVAL '12 hours'
+        WHERE expires_at IS NULL AND category = 'food';
+        UPDATE ads SET expires_at = created_at + INTERVAL '30 days'
+        WHERE expires_at IS NULL;
+
+        CREATE INDEX IF NOT EXISTS ads_expires_idx ON ads (expires_at);
+        """,
+    ),
+    (
+        9,
+        "categories",
+        """
+        -- лента каждой категории — свой частичный индекс (категория в запросах литералом)
+        CREATE INDEX IF NOT EXISTS ads_feed_food_idx
+            ON ads (created_at DESC, id DESC)
+            WHERE category = 'food' AND approved = TRUE;
+        CREATE INDEX IF NOT EXISTS ads_feed_market_idx
+            ON ads (created_at DESC, id DESC)
+            WHERE category = 'market' AND approved = TRUE;
+        CREATE INDEX IF NOT EXISTS ads_feed_study_idx
+            ON ads (created_at DESC, id DESC)
+            WHERE category = 'study' AND approved = TRUE;
+        DROP INDEX IF EXISTS ads_feed_idx;
+
+        -- рейтинг по общаге — тоже по категориям
+        ALTER TABLE feed_rank ADD COLUMN IF NOT EXISTS category TEXT NOT NULL DEFAULT 'food';
+        UPDATE feed_rank r SET category = a.category
+        FROM ads a
+        WHERE a.id = r.ad_id AND a.category <> r.category;
+        ALTER TABLE feed_rank ALTER COLUMN category DROP DEFAULT;
+
+        DROP INDEX IF EXISTS feed_rank_order_idx;
+        CREATE INDEX feed_rank_order_idx
+            ON feed_rank (category, viewer_dorm, score DESC, ad_id DESC);
+        """,
+    ),
+    (
+        10,
+        "moderation queue",
+        """
+        -- очередь модерации: WHERE NOT approved ORDER BY created_at, id (+ keyset)
+        CREATE INDEX IF NOT EXISTS ads_review_idx
+            ON ads (created_at, id)
+            WHERE NOT approved;
+        """,
+    ),
+    (
+        11,
+        "idempotency keys",
+        """
+        -- публикация: "<user_id>:<токен анкеты>", повторная вставка — no-op
+        ALTER TABLE ads ADD COLUMN IF NOT EXISTS idem_key TEXT;
+        CREATE UNIQUE INDEX IF NOT EXISTS ads_idem_key_idx
+            ON ads (idem_key)
+            WHERE idem_key IS NOT NULL;
+
+        -- разовые действия без своей строки (уведомление продавцу о ❤️ ...)
+        CREATE TABLE IF NOT EXISTS action_keys (
+            key TEXT PRIMARY KEY,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS action_keys_created_idx ON action_keys (created_at);
+        """,
+    ),
+    (
+        12,
+        "keep ad stats",
+        """
+        -- дневная статистика переживает объявление: janitor удаляет
+        -- просроченные, а история просмотров и ❤️ нужна и после
+        ALTER TABLE ad_stats_daily DROP CONSTRAINT IF EXISTS ad_stats_daily_ad_id_fkey;
+        """,
+    ),
+    (
+        13,
+        "approval time",
+        """
+        -- когда объявление стало видно в лентах (сразу или после модерации);
+        -- сводка админу считает опубликованные по нему, а не по created_at
+        ALTER TABLE ads ADD COLUMN IF NOT EXISTS approved_at TIMESTAMPTZ;
+        UPDATE ads SET approved_at = created_at WHERE approved AND approved_at IS NULL;
+        CREATE INDEX IF NOT EXISTS ads_approved_at_idx
+            ON ads (approved_at)
+            WHERE approved_at IS NOT NULL;
+        """,
+    ),
+    (
+        14,
+        "fsm version",
+        """
+        -- upsert в fsm проходит только с версией новее сохранённой
+        ALTER TABLE fsm ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+        """,
+    ),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_ID = 0x67766662  # "gvfb"
+
+
+async def _schema_version(conn: asyncpg.Connection) -> int:
+    exists = await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not exists:
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+
+async def db_migrate(conn: asyncpg.Connection) -> None:
+    if await _schema_version(conn) >= SCHEMA_VERSION:
+        return
 
-        # ads
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+    try:
         await conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS ads (
-                id BIGSERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-                category TEXT NOT NULL,
-                photo_file_id TEXT,
-                price TEXT,
-                description TEXT,
-                dorm INTEGER,
-                location TEXT,
-                views INTEGER NOT NULL DEFAULT 0,
-                approved BOOLEAN NOT NULL DEFAULT TRUE,
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
             );
             """
         )
+        # перечитываем под локом: другая реплика могла успеть раньше
+        current = await _schema_version(conn)
+        for version, name, sql in MIGRATIONS:
+            if version <= current:
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_version(version, name) VALUES($1, $2)",
+                    version,
+                    name,
+                )
+            logging.info("[db] migration %s applied: %s", version, name)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
 
-        # settings (tech mode)
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL
-            );
-            """
-        )
 
-        await conn.execute(
-            """
-            INSERT INTO settings(key, value)
-            VALUES ('tech_mode', 'false')
-            ON CONFLICT (key) DO NOTHING;
-            """
-        )
+# ================= DB =================
+# Запросы горячего пути регистрируются в QUERIES через query(name, sql) рядом
+# со своим хелпером и готовятся (PREPARE) лениво — при первом вызове на
+# данном соединении. Готовить все сразу в init-хуке дорого: пул закрывает
+# простаивающие соединения (DB_MAX_INACTIVE_LIFETIME), и новое соединение
+# платило бы десятками round-trip'ов на запросе случайного юзера.
+# Хелперы вызывают их по имени: db_fetchrow(Q_..., *args).
+# db_acquire() — единственная точка входа в пул, она же меряет ожидание
+# свободного соединения (pool_stats(), gvf_db_pool_wait_seconds).
+
+QUERIES: dict[str, str] = {}
+
+
+def query(name: str, sql: str) -> str:
+    if name in QUERIES:
+        raise RuntimeError(f"duplicate query name: {name}")
+    QUERIES[name] = sql
+    return name
+
 
-    logging.info("[db] initialized")
+class GvfConnection(asyncpg.Connection):
+    __slots__ = ("stmts",)
+
+
+async def _init_connection(conn: GvfConnection) -> None:
+    conn.stmts = {}
+
+
+_pool: Optional[asyncpg.Pool] = None
+
+
+async def db_init() -> None:
+    global _pool
+
+    # миграции — отдельным соединением до пула, чтобы prepared statements
+    # готовились уже на актуальной схеме
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await db_migrate(conn)
+    finally:
+        await conn.close()
+
+    started = time.perf_counter()
+    # min_size соединений открываются сразу — первые пользователи после
+    # деплоя не платят за холодный коннект
+    _pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        connection_class=GvfConnection,
+        init=_init_connection,
+    )
+    logging.info(
+        "[db] pool ready: %s connections, %s registered queries, %.0f ms",
+        _pool.get_size(),
+        len(QUERIES),
+        (time.perf_counter() - started) * 1000,
+    )
+
+    async with db_acquire() as conn:
+        await db_load_settings(conn)
+
+    logging.info("[db] initialized (schema v%s)", SCHEMA_VERSION)
 
 
 def db_pool() -> asyncpg.Pool:
@@ -112,58 +676,291 @@ def db_pool() -> asyncpg.Pool:
     return _pool
 
 
+@asynccontextmanager
+async def db_acquire(timeout: Optional[float] = None) -> AsyncIterator[GvfConnection]:
+    started = time.perf_counter()
+    async with db_pool().acquire(timeout=timeout) as conn:
+        _db_pool_wait.observe(time.perf_counter() - started)
+        yield conn
+
+
+def pool_stats() -> dict[str, Any]:
+    pool = db_pool()
+    acquires = _db_pool_wait.count()
+    return {
+        "size": pool.get_size(),
+        "idle": pool.get_idle_size(),
+        "max": pool.get_max_size(),
+        "acquires": acquires,
+        "wait_avg_ms": _db_pool_wait.sums.get("", 0.0) / acquires * 1000 if acquires else 0.0,
+        "wait_p95_ms": _db_pool_wait.quantile(0.95) * 1000,
+    }
+
+
+async def _run(conn: GvfConnection, name: str, method: str, args: tuple) -> Any:
+    started = time.perf_counter()
+    try:
+        stmt = conn.stmts.get(name)
+        if stmt is None:
+            if DB_STATEMENT_CACHE_SIZE <= 0:
+                return await getattr(conn, method)(QUERIES[name], *args)
+            stmt = conn.stmts[name] = await conn.prepare(QUERIES[name])
+        return await getattr(stmt, method)(*args)
+    finally:
+        _db_query_seconds.observe(time.perf_counter() - started, name)
+
+
+async def db_fetch(name: str, *args: Any, conn: Optional[GvfConnection] = None) -> list[asyncpg.Record]:
+    if conn is not None:
+        return await _run(conn, name, "fetch", args)
+    async with db_acquire() as conn:
+        return await _run(conn, name, "fetch", args)
+
+
+async def db_fetchrow(name: str, *args: Any, conn: Optional[GvfConnection] = None) -> Optional[asyncpg.Record]:
+    if conn is not None:
+        return await _run(conn, name, "fetchrow", args)
+    async with db_acquire() as conn:
+        return await _run(conn, name, "fetchrow", args)
+
+
+async def db_fetchval(name: str, *args: Any, conn: Optional[GvfConnection] = None) -> Any:
+    if conn is not None:
+        return await _run(conn, name, "fetchval", args)
+    async with db_acquire() as conn:
+        return await _run(conn, name, "fetchval", args)
+
+
+# ================= USER CACHE =================
+# LRU + TTL поверх таблицы users. Строка меняется только в db_upsert_user /
+# db_set_phone_verified — они пишут в кэш сами (write-through).
+# Отсутствие пользователя тоже кэшируется (None), чтобы /start от новичков
+# не долбил базу. Write-through видит только свой процесс, поэтому
+# неверифицированные строки и None живут USER_CACHE_UNVERIFIED_TTL, а не
+# USER_CACHE_TTL: юзер, прошедший верификацию через другую реплику, не
+# получит здесь «сначала подтверди номер» на пять минут.
+
+_MISSING = object()
+
+
+class UserCache:
+    def __init__(self, maxsize: int, ttl: float, unverified_ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.unverified_ttl = unverified_ttl
+        self._data: OrderedDict[int, tuple[float, Optional[asyncpg.Record]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> Any:
+        item = self._data.get(user_id)
+        if item is None:
+            self.misses += 1
+            return _MISSING
+        expires, row = item
+        if expires < time.monotonic():
+            del self._data[user_id]
+            self.misses += 1
+            return _MISSING
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return row
+
+    def put(self, user_id: int, row: Optional[asyncpg.Record]) -> None:
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if row is not None and row["is_verified"] else self.unverified_ttl
+        self._data[user_id] = (time.monotonic() + ttl, row)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def evict(self, user_id: int) -> None:
+        self._data.pop(user_id, None)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+_user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL, USER_CACHE_UNVERIFIED_TTL)
+
+
+def user_cache_stats() -> dict[str, int]:
+    return _user_cache.stats()
+
+
+gauge("gvf_user_cache_size", "Cached users", lambda: len(_user_cache._data))
+counter_fn("gvf_user_cache_hits_total", "User cache hits", lambda: _user_cache.hits)
+counter_fn("gvf_user_cache_misses_total", "User cache misses", lambda: _user_cache.misses)
+gauge("gvf_db_pool_size", "Open pool connections", lambda: db_pool().get_size())
+gauge("gvf_db_pool_idle", "Idle pool connections", lambda: db_pool().get_idle_size())
+
+
 # ================= DB HELPERS =================
 
+# явный список колонок: prepared statement с * ломается после ALTER TABLE
+_USER_COLS = "user_id, username, phone, is_verified, is_blocked, dorm"
+
+Q_USER_GET = query("user_get", f"SELECT {_USER_COLS} FROM users WHERE user_id=$1")
+
+Q_USER_UPSERT = query(
+    "user_upsert",
+    f"""
+    INSERT INTO users(user_id, username)
+    VALUES($1, $2)
+    ON CONFLICT (user_id)
+    DO UPDATE SET username=EXCLUDED.username, is_blocked=FALSE, updated_at=NOW()
+    RETURNING {_USER_COLS}
+    """,
+)
+
+Q_USER_VERIFY = query(
+    "user_verify",
+    f"""
+    INSERT INTO users(user_id, username, phone, is_verified)
+    VALUES($1, $2, $3, TRUE)
+    ON CONFLICT (user_id)
+    DO UPDATE SET
+        username=EXCLUDED.username,
+        phone=EXCLUDED.phone,
+        is_verified=TRUE,
+        updated_at=NOW()
+    RETURNING {_USER_COLS}
+    """,
+)
+
+
+Q_USER_SET_DORM = query(
+    "user_set_dorm",
+    f"UPDATE users SET dorm=$2, updated_at=NOW() WHERE user_id=$1 RETURNING {_USER_COLS}",
+)
+
+
 async def db_get_user(user_id: int) -> Optional[asyncpg.Record]:
-    async with db_pool().acquire() as conn:
-        return await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", user_id)
+    row = _user_cache.get(user_id)
+    if row is not _MISSING:
+        return row
+
+    row = await db_fetchrow(Q_USER_GET, user_id)
+    _user_cache.put(user_id, row)
+    return row
 
 
 async def db_upsert_user(user_id: int, username: Optional[str]) -> None:
-    async with db_pool().acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO users(user_id, username)
-            VALUES($1, $2)
-            ON CONFLICT (user_id)
-            DO UPDATE SET username=EXCLUDED.username, updated_at=NOW();
-            """,
-            user_id,
-            username,
-        )
+    row = await db_fetchrow(Q_USER_UPSERT, user_id, username)
+    _user_cache.put(user_id, row)
 
 
 async def db_set_phone_verified(user_id: int, username: Optional[str], phone: str) -> None:
-    async with db_pool().acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO users(user_id, username, phone, is_verified)
-            VALUES($1, $2, $3, TRUE)
-            ON CONFLICT (user_id)
-            DO UPDATE SET
-                username=EXCLUDED.username,
-                phone=EXCLUDED.phone,
-                is_verified=TRUE,
-                updated_at=NOW();
-            """,
-            user_id,
-            username,
-            phone,
-        )
+    row = await db_fetchrow(Q_USER_VERIFY, user_id, username, phone)
+    _user_cache.put(user_id, row)
+
+
+async def db_set_user_dorm(user_id: int, dorm: int) -> None:
+    # общага зрителя для ранжированной ленты; пишем, только если поменялась
+    user = await db_get_user(user_id)
+    if user is not None and user["dorm"] == dorm:
+        return
+    row = await db_fetchrow(Q_USER_SET_DORM, user_id, dorm)
+    _user_cache.put(user_id, row)
+
+
+# ================= SETTINGS =================
+# Таблица settings целиком живёт в памяти. Запись идёт через db_set_setting,
+# который в той же транзакции шлёт NOTIFY; каждый процесс бота держит
+# отдельное LISTEN-соединение и обновляет свою копию. На том же соединении
+# слушается и gvf_fsm (сброс кэша FSM, см. FSM STORAGE).
+
+SETTINGS_CHANNEL = "gvf_settings"
 
+_settings: dict[str, str] = {}
 
-async def db_is_tech_mode() -> bool:
-    async with db_pool().acquire() as conn:
-        row = await conn.fetchrow("SELECT value FROM settings WHERE key='tech_mode'")
-        return row and row["value"] == "true"
+
+def setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    return _settings.get(key, default)
+
+
+def is_tech_mode() -> bool:
+    return setting("tech_mode") == "true"
+
+
+async def db_load_settings(conn: Optional[asyncpg.Connection] = None) -> None:
+    if conn is None:
+        async with db_acquire() as conn:
+            rows = await conn.fetch("SELECT key, value FROM settings")
+    else:
+        rows = await conn.fetch("SELECT key, value FROM settings")
+    _settings.clear()
+    _settings.update({r["key"]: r["value"] for r in rows})
+
+
+async def db_set_setting(key: str, value: str) -> None:
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                INSERT INTO settings(key, value)
+                VALUES($1, $2)
+                ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value
+                """,
+                key,
+                value,
+            )
+            await conn.execute(
+                "SELECT pg_notify($1, json_build_object('key', $2::text, 'value', $3::text)::text)",
+                SETTINGS_CHANNEL,
+                key,
+                value,
+            )
+    _settings[key] = value
 
 
 async def db_set_tech_mode(value: bool) -> None:
-    async with db_pool().acquire() as conn:
-        await conn.execute(
-            "UPDATE settings SET value=$1 WHERE key='tech_mode'",
-            "true" if value else "false",
-        )
+    await db_set_setting("tech_mode", "true" if value else "false")
+
+
+def _on_settings_notify(conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+    try:
+        msg = json.loads(payload)
+        _settings[msg["key"]] = msg["value"]
+    except (ValueError, KeyError, TypeError):
+        logging.warning("[settings] bad notify payload: %r", payload)
+
+
+async def settings_listener() -> None:
+    # держим LISTEN-соединение; после обрыва переподключаемся и перечитываем
+    # таблицу целиком, т.к. пока нас не было, NOTIFY могли потеряться
+    delay = 1.0
+    while True:
+        conn: Optional[asyncpg.Connection] = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda _conn: closed.set())
+            await conn.add_listener(SETTINGS_CHANNEL, _on_settings_notify)
+            await conn.add_listener(FSM_CHANNEL, _on_fsm_notify)
+            await db_load_settings(conn)
+            fsm_storage.invalidate()
+            logging.info("[settings] listening on %s", SETTINGS_CHANNEL)
+            delay = 1.0
+            await closed.wait()
+            logging.warning("[settings] listen connection lost")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("[settings] listener failed")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30.0)
 
 
 # ================= HELPERS =================
@@ -178,6 +975,17 @@ def user_link_md(user_id: int, username: Optional[str], label: str) -> str:
 def chat_url(user_id: int, username: Optional[str]) -> str:
     return f"tg://user?id={user_id}" if user_id else (f"https://t.me/{username}" if username else "")
 
+
+_bg_tasks: set[asyncio.Task] = set()
+
+
+def spawn(coro: Awaitable[Any]) -> asyncio.Task:
+    # держим ссылку на фоновую задачу, чтобы её не собрал GC
+    task = asyncio.ensure_future(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
+
 # ================= UI / KEYBOARDS =================
 
 START_BTN_TEXT = "▶️ Начать"
@@ -224,21 +1032,247 @@ def contact_kb() -> ReplyKeyboardMarkup:
 
 # ================= FSM =================
 
-class FoodAdd(StatesGroup):
-    photo = State()
-    price = State()
-    description = State()
-    dorm = State()
-    location = State()
+class AdCreate(StatesGroup):
+    field = State()  # поля анкеты по очереди (cat.fields)
     confirm = State()
 
 
+class AdSearch(StatesGroup):
+    query = State()
+
+
 class AdminPanel(StatesGroup):
     delete_ad_id = State()
     broadcast_text = State()
     broadcast_confirm = State()
 
 
+# ================= FSM STORAGE =================
+# Состояния FSM в Postgres, чтобы недозаполненные объявления переживали
+# деплой и работали с несколькими репликами.
+#   * set_state пишет сразу (вместе с накопленными данными) — одна запись
+#     на шаг диалога вместо двух;
+#   * update_data/set_data только помечают запись грязной, фоновый flusher
+#     раз в FSM_FLUSH_SEC сбрасывает всё одной пачкой;
+#   * маленький read-through кэш с коротким TTL (FSM_CACHE_TTL), включая
+#     «записи нет» — FSMContextMiddleware спрашивает состояние на каждом
+#     апдейте, и листание не должно ходить в базу;
+#   * каждая запись в fsm шлёт NOTIFY gvf_fsm "<процесс>:<ключ>" в том же
+#     запросе; остальные процессы слушают канал на соединении настроек и
+#     выкидывают у себя чистую запись с этим ключом — шаг, сделанный на
+#     соседней реплике, виден сразу. Пока LISTEN-соединение лежит,
+#     остаётся окно FSM_CACHE_TTL (после переподключения чистый кэш
+#     сбрасывается целиком);
+#   * у записи есть version: каждое изменение в процессе её поднимает, а
+#     upsert проходит только с версией больше той, что в базе. Так снимок
+#     flusher'а, который set_state обогнал, не откатит шаг назад, а запись
+#     поверх чужой, более новой, отбрасывается (наша копия сбрасывается).
+#     Строки не удаляются (пустая запись — «состояния нет»), иначе старый
+#     снимок воскресил бы закрытый диалог;
+#   * брошенные диалоги старше FSM_TTL_SEC не читаются и вычищаются.
+
+Q_FSM_GET = query(
+    "fsm_get",
+    """
+    SELECT state, data, version FROM fsm
+    WHERE key=$1 AND updated_at > NOW() - make_interval(secs => $2)
+    """,
+)
+
+FSM_CHANNEL = "gvf_fsm"
+FSM_ORIGIN = secrets.token_hex(4)  # свои NOTIFY не обрабатываем
+
+Q_FSM_PUT = query(
+    "fsm_put",
+    f"""
+    WITH w AS (
+        INSERT INTO fsm(key, state, data, version, updated_at)
+        VALUES($1, $2, $3::jsonb, $5, NOW())
+        ON CONFLICT (key) DO UPDATE
+        SET state=EXCLUDED.state, data=EXCLUDED.data, version=EXCLUDED.version, updated_at=NOW()
+        WHERE fsm.version < EXCLUDED.version
+        RETURNING key
+    )
+    SELECT pg_notify('{FSM_CHANNEL}', $4::text || ':' || key) FROM w
+    """,
+)
+
+
+class _FsmEntry:
+    __slots__ = ("state", "data", "version", "expires", "dirty")
+
+    def __init__(self, state: Optional[str], data: dict[str, Any], version: int = 0):
+        self.state = state
+        self.data = data
+        self.version = version
+        self.expires = time.monotonic() + FSM_CACHE_TTL
+        self.dirty = False
+
+    def written(self) -> None:
+        self.expires = time.monotonic() + FSM_CACHE_TTL
+
+
+class PgStorage(BaseStorage):
+    def __init__(self) -> None:
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache: OrderedDict[str, _FsmEntry] = OrderedDict()
+        self._dirty: set[str] = set()
+
+    async def _entry(self, key: StorageKey) -> tuple[str, _FsmEntry]:
+        k = self.key_builder.build(key)
+        entry = self._cache.get(k)
+        if entry is not None and (entry.dirty or entry.expires > time.monotonic()):
+            self._cache.move_to_end(k)
+            return k, entry
+
+        row = await db_fetchrow(Q_FSM_GET, k, FSM_TTL_SEC)
+        entry = _FsmEntry(row["state"], json.loads(row["data"]), row["version"]) if row else _FsmEntry(None, {})
+        self._cache[k] = entry
+        self._trim()
+        return k, entry
+
+    def _trim(self) -> None:
+        # грязные записи не выкидываем — их сначала заберёт flusher
+        if len(self._cache) <= FSM_CACHE_SIZE:
+            return
+        for k in list(self._cache):
+            if len(self._cache) <= FSM_CACHE_SIZE:
+                break
+            if not self._cache[k].dirty:
+                del self._cache[k]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        entry.version += 1
+        entry.dirty = False
+        entry.written()
+        self._dirty.discard(k)
+
+        rows = await db_fetch(Q_FSM_PUT, k, entry.state, json.dumps(entry.data), FSM_ORIGIN, entry.version)
+        if not rows:
+            # соседняя реплика записала более новую версию — перечитаем
+            logging.warning("[fsm] stale write dropped for %s", k)
+            self.invalidate(k)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, entry = await self._entry(key)
+        return entry.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k, entry = await self._entry(key)
+        entry.data = dict(data)
+        entry.version += 1
+        entry.dirty = True
+        entry.written()
+        self._dirty.add(k)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, entry = await self._entry(key)
+        return entry.data.copy()
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        keys = list(self._dirty)
+        self._dirty.clear()
+
+        upsert_keys: list[str] = []
+        upsert_states: list[Optional[str]] = []
+        upsert_data: list[str] = []
+        upsert_versions: list[int] = []
+        for k in keys:
+            entry = self._cache.get(k)
+            if entry is None or not entry.dirty:
+                continue
+            entry.dirty = False
+            upsert_keys.append(k)
+            upsert_states.append(entry.state)
+            upsert_data.append(json.dumps(entry.data))
+            upsert_versions.append(entry.version)
+        if not upsert_keys:
+            return
+
+        try:
+            async with db_acquire() as conn:
+                # состояние не трогаем: его пишет set_state; снимок, который
+                # set_state успел обогнать, по версии не перетрёт его запись
+                rows = await conn.fetch(
+                    """
+                    WITH w AS (
+                        INSERT INTO fsm(key, state, data, version, updated_at)
+                        SELECT k, s, d::jsonb, v, NOW()
+                        FROM unnest($1::text[], $2::text[], $3::text[], $4::bigint[]) AS u(k, s, d, v)
+                        ON CONFLICT (key) DO UPDATE
+                        SET data=EXCLUDED.data, version=EXCLUDED.version, updated_at=NOW()
+                        WHERE fsm.version < EXCLUDED.version
+                        RETURNING key
+                    )
+                    SELECT key, pg_notify($5, $6::text || ':' || key) FROM w
+                    """,
+                    upsert_keys,
+                    upsert_states,
+                    upsert_data,
+                    upsert_versions,
+                    FSM_CHANNEL,
+                    FSM_ORIGIN,
+                )
+        except Exception:
+            # вернём в очередь, попробуем в следующий раз
+            for k in upsert_keys:
+                entry = self._cache.get(k)
+                if entry is not None:
+                    entry.dirty = True
+                    self._dirty.add(k)
+            raise
+
+        # в базе версия новее, а запись с тех пор не менялась — её писала
+        # другая реплика, наша копия устарела
+        written = {r["key"] for r in rows}
+        for k, version in zip(upsert_keys, upsert_versions):
+            entry = self._cache.get(k)
+            if k not in written and entry is not None and entry.version == version:
+                self.invalidate(k)
+
+    def invalidate(self, k: Optional[str] = None) -> None:
+        # k=None — все чистые записи (NOTIFY могли потеряться)
+        if k is None:
+            for k in [k for k, e in self._cache.items() if not e.dirty]:
+                del self._cache[k]
+            return
+        entry = self._cache.get(k)
+        if entry is not None and not entry.dirty:
+            del self._cache[k]
+
+    async def flusher(self) -> None:
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(FSM_FLUSH_SEC)
+            try:
+                await self.flush()
+                if time.monotonic() - last_sweep > 600:
+                    last_sweep = time.monotonic()
+                    async with db_acquire() as conn:
+                        await conn.execute(
+                            "DELETE FROM fsm WHERE updated_at < NOW() - make_interval(secs => $1)",
+                            FSM_TTL_SEC,
+                        )
+            except Exception:
+                logging.exception("[fsm] flush failed")
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+fsm_storage = PgStorage()
+
+
+def _on_fsm_notify(conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+    origin, _, k = payload.partition(":")
+    if origin != FSM_ORIGIN:
+        fsm_storage.invalidate(k)
+
+
 # ================= HELPERS =================
 
 async def ensure_verified(message: Message) -> bool:
@@ -246,14 +1280,247 @@ async def ensure_verified(message: Message) -> bool:
     return bool(user and user["is_verified"])
 
 
+# ================= THROTTLE =================
+# Токен-бакет на юзера перед всем остальным (даже до загрузки юзера и
+# флага техработ), чтобы один бешеный кликер или скрипт не съедал пул.
+# Стоимость — по группе callback_data:
+#   nav     <key>_prev/_next/_rprev/_rnext/_sprev/_snext, my_prev/my_next
+#   heavy   <key>_publish, <key>_take
+#   default всё остальное и сообщения (шаги анкет, команды)
+# Не хватило токенов:
+#   * листание ждёт пополнения (до THROTTLE_MAX_WAIT), и если за это время
+#     пришло ещё одно листание, ждущее отбрасывается — обработается только
+#     последнее нажатие;
+#   * остальное отбрасывается сразу с коротким ответом на callback.
+# Бакеты — компактные объекты со __slots__; кто не кликал дольше, чем
+# нужно на полное пополнение, выметается (его бакет и так был бы полным).
+
+THROTTLE_NAV = {"prev", "next", "rprev", "rnext", "sprev", "snext"}
+THROTTLE_HEAVY = {"publish", "take"}
+
+
+def throttle_group(event: TelegramObject) -> str:
+    if not isinstance(event, CallbackQuery):
+        return "default"
+    action = (event.data or "").partition(":")[0].rpartition("_")[2]
+    if action in THROTTLE_NAV:
+        return "nav"
+    if action in THROTTLE_HEAVY:
+        return "heavy"
+    return "default"
+
+
+class _Bucket:
+    __slots__ = ("tokens", "ts", "gen")
+
+    def __init__(self, tokens: float, ts: float) -> None:
+        self.tokens = tokens
+        self.ts = ts
+        self.gen = 0  # номер последнего ждущего листания
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self, rate: float, burst: float, costs: Mapping[str, float], max_wait: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs
+        self.max_wait = max_wait
+        self.idle = burst / rate if rate > 0 else 0.0
+        self._buckets: dict[int, _Bucket] = {}
+        self._swept = time.monotonic()
+
+    def _refill(self, b: _Bucket, now: float) -> None:
+        b.tokens = min(self.burst, b.tokens + (now - b.ts) * self.rate)
+        b.ts = now
+
+    def _sweep(self, now: float) -> None:
+        self._swept = now
+        cutoff = now - self.idle
+        for user_id in [u for u, b in self._buckets.items() if b.ts < cutoff]:
+            del self._buckets[user_id]
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        from_user: Optional[User] = data.get("event_from_user")
+        if self.rate <= 0 or from_user is None or from_user.id == ADMIN_ID:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now - self._swept > self.idle:
+            self._sweep(now)
+
+        group = throttle_group(event)
+        cost = self.costs[group]
+        b = self._buckets.get(from_user.id)
+        if b is None:
+            b = self._buckets[from_user.id] = _Bucket(self.burst, now)
+        self._refill(b, now)
+
+        if b.tokens < cost:
+            wait = (cost - b.tokens) / self.rate
+            if group != "nav" or wait > self.max_wait:
+                _throttled.inc(group, "dropped")
+                if isinstance(event, CallbackQuery):
+                    await event.answer("⏳ Слишком часто, подожди секунду")
+                return None
+
+            b.gen += 1
+            gen = b.gen
+            _throttled.inc(group, "delayed")
+            await asyncio.sleep(wait)
+            if b.gen != gen:
+                # пока ждали, юзер нажал ещё раз — обработаем то нажатие,
+                # а это просто гасим, чтобы у кнопки не висели «часики»
+                _throttled.inc(group, "coalesced")
+                await event.answer()
+                return None
+            if self._buckets.get(from_user.id) is not b:
+                self._buckets[from_user.id] = b
+            self._refill(b, time.monotonic())
+
+        b.tokens -= cost
+        return await handler(event, data)
+
+
+throttle = ThrottleMiddleware(
+    THROTTLE_RATE,
+    THROTTLE_BURST,
+    {"nav": THROTTLE_COST_NAV, "default": THROTTLE_COST_DEFAULT, "heavy": THROTTLE_COST_HEAVY},
+    THROTTLE_MAX_WAIT,
+)
+gauge("gvf_throttle_buckets", "Users with a live throttle bucket", lambda: len(throttle._buckets))
+
+
+# ================= MIDDLEWARE =================
+# Пользователь и флаг техработ грузятся один раз на апдейт и
+# прокидываются в хендлеры как `user` / `tech_mode`.
+# Проверки объявляются флагами хендлера:
+#   flags={"verified": True}  — нужен подтверждённый номер
+#   flags={"tech": True}      — закрыто во время техработ (кроме админа)
+#   flags={"lock": True}      — повторное нажатие той же кнопки, пока первое
+#                               выполняется или только что (ACTION_DEDUP_SEC)
+#                               выполнилось, молча отбрасывается
+
+class UserContextMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        from_user: Optional[User] = data.get("event_from_user")
+        data["user"] = None
+        if from_user is not None:
+            data["user"] = await db_get_user(from_user.id)
+        data["tech_mode"] = is_tech_mode()
+        return await handler(event, data)
+
+
+class AccessGateMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, CallbackQuery):
+            return await handler(event, data)
+
+        if get_flag(data, "verified"):
+            user = data.get("user")
+            if not user or not user["is_verified"]:
+                await event.answer("Подтверди номер через ▶️ Начать", show_alert=True)
+                return None
+
+        if get_flag(data, "tech"):
+            if data.get("tech_mode") and event.from_user.id != ADMIN_ID:
+                await event.answer("🛠 Техработы", show_alert=True)
+                return None
+
+        return await handler(event, data)
+
+
+class ActionLockMiddleware(BaseMiddleware):
+    # Ключ — (юзер, callback_data, сообщение): двойной тап по «Опубликовать»
+    # или «Забрать» второй раз не доходит ни до базы, ни до Telegram.
+    # Только в памяти процесса — между репликами дубли ловят ключи
+    # идемпотентности в базе (ads.idem_key, action_keys).
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._inflight: set[tuple] = set()
+        # ключ -> monotonic до которого повтор отбрасывается; окно одно на
+        # всех, так что порядок вставки = порядок истечения
+        self._recent: OrderedDict[tuple, float] = OrderedDict()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, CallbackQuery) or not get_flag(data, "lock"):
+            return await handler(event, data)
+
+        now = time.monotonic()
+        while self._recent and next(iter(self._recent.values())) <= now:
+            self._recent.popitem(last=False)
+
+        msg_id = event.message.message_id if event.message else event.inline_message_id
+        key = (event.from_user.id, event.data, msg_id)
+        if key in self._inflight or key in self._recent:
+            _actions_dropped.inc(data["handler"].callback.__name__)
+            return None
+
+        self._inflight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._inflight.discard(key)
+            self._recent[key] = time.monotonic() + self.window
+
+
+action_lock = ActionLockMiddleware(ACTION_DEDUP_SEC)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            _handler_errors.inc(name)
+            raise
+        finally:
+            _handler_seconds.observe(time.perf_counter() - started, name)
+
+
+router.message.outer_middleware(throttle)
+router.callback_query.outer_middleware(throttle)
+router.message.outer_middleware(UserContextMiddleware())
+router.callback_query.outer_middleware(UserContextMiddleware())
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(action_lock)
+router.callback_query.middleware(AccessGateMiddleware())
+
+
 # ================= START / ONBOARDING =================
 
 @router.message(CommandStart())
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, user: Optional[asyncpg.Record]):
+    # upsert only touches username, so the row loaded by the middleware is still current
     await db_upsert_user(message.from_user.id, message.from_user.username)
 
-    user = await db_get_user(message.from_user.id)
-
     # If already verified — go straight to menu
     if user and user["is_verified"]:
         await message.answer(
@@ -274,8 +1541,7 @@ async def cmd_start(message: Message):
 
 
 @router.callback_query(F.data == "start_go")
-async def start_go(call: CallbackQuery):
-    user = await db_get_user(call.from_user.id)
+async def start_go(call: CallbackQuery, user: Optional[asyncpg.Record]):
 
     # Если пользователь уже подтверждён — сразу показываем главное меню
     if user and user["is_verified"]:
@@ -286,10 +1552,11 @@ async def start_go(call: CallbackQuery):
                 parse_mode="Markdown",
             )
         except Exception:
+            swallowed("start_go.edit")
             try:
                 await call.message.delete()
             except Exception:
-                pass
+                swallowed("start_go.delete")
             await call.message.answer(
                 "🏠 *Главное меню*",
                 reply_markup=main_menu_ikb(),
@@ -303,7 +1570,7 @@ async def start_go(call: CallbackQuery):
     try:
         await call.message.delete()
     except Exception:
-        pass
+        swallowed("start_go.delete")
 
     await call.message.answer(
         "Для работы с ботом нужно подтвердить номер 📱",
@@ -352,12 +1619,8 @@ async def global_cancel(message: Message, state: FSMContext):
 
 # ================= MAIN MENU =================
 
-@router.callback_query(F.data == "menu_home")
+@router.callback_query(F.data == "menu_home", flags={"tech": True})
 async def menu_home(call: CallbackQuery):
-    if await db_is_tech_mode() and call.from_user.id != ADMIN_ID:
-        await call.answer("🛠 Техработы", show_alert=True)
-        return
-
     try:
         # Works if message is text
         await call.message.edit_text(
@@ -367,10 +1630,11 @@ async def menu_home(call: CallbackQuery):
         )
     except Exception:
         # Fallback for photo messages
+        swallowed("menu_home.edit")
         try:
             await call.message.delete()
         except Exception:
-            pass
+            swallowed("menu_home.delete")
         await call.message.answer(
             "🏠 *Главное меню*",
             reply_markup=main_menu_ikb(),
@@ -395,514 +1659,1508 @@ async def menu_help(call: CallbackQuery):
 
 
 
-# ================= MARKET (БАРАХОЛКА) =================
+# ================= CURSORS =================
+# Навигация — keyset по (created_at, id). Курсор текущего объявления едет
+# прямо в callback_data: "<unix_us>:<id>", так что позиций в памяти нет.
 
-@router.callback_query(F.data == "menu_market")
-async def menu_market(call: CallbackQuery):
-    user = await db_get_user(call.from_user.id)
-    if not user or not user["is_verified"]:
-        await call.answer("Подтверди номер через ▶️ Начать", show_alert=True)
-        return
-    if await db_is_tech_mode() and call.from_user.id != ADMIN_ID:
-        await call.answer("🛠 Техработы", show_alert=True)
-        return
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_US = timedelta(microseconds=1)
 
-    await call.message.edit_text(
-        "🛒 *Барахолка*\n\n"
-        "Здесь можно продавать и покупать вещи, технику и услуги.\n"
-        "Скоро добавим объявления 👀",
-        reply_markup=back_menu_ikb(),
-        parse_mode="Markdown",
-    )
-    await call.answer()
 
+def ts_us(dt: datetime) -> int:
+    return (dt - _EPOCH) // _US
 
-# ================= ADS (FOOD) =================
-_food_pos: dict[int, int] = {}
-_my_pos: dict[int, int] = {}
 
-@router.callback_query(F.data == "menu_my")
-async def menu_my(call: CallbackQuery):
-    user = await db_get_user(call.from_user.id)
-    if not user or not user["is_verified"]:
-        await call.answer("Подтверди номер через ▶️ Начать", show_alert=True)
-        return
-    if await db_is_tech_mode() and call.from_user.id != ADMIN_ID:
-        await call.answer("🛠 Техработы", show_alert=True)
-        return
+def encode_cursor(created_at: datetime, ad_id: int) -> str:
+    return f"{ts_us(created_at)}:{ad_id}"
 
-    async with db_pool().acquire() as conn:
-        ads = await conn.fetch(
-            "SELECT * FROM ads WHERE user_id=$1 ORDER BY created_at DESC LIMIT 50",
-            call.from_user.id,
-        )
 
-    if not ads:
-        await call.message.edit_text(
-            "📭 *У тебя пока нет объявлений*",
-            reply_markup=back_menu_ikb(),
-            parse_mode="Markdown",
-        )
+def decode_cursor(raw: str) -> Optional[tuple[datetime, int]]:
+    try:
+        us, ad_id = raw.split(":")
+        return _EPOCH + timedelta(microseconds=int(us)), int(ad_id)
+    except ValueError:
+        return None
+
+
+# ================= AD MODEL =================
+# Объявление между базой и экраном. Каждый экран выбирает только свои
+# колонки (AD_FEED_COLS, AD_MY_COLS ...), остальные слоты остаются None.
+# __slots__ — без __dict__ на объект, лента из сотен объявлений занимает
+# минимум памяти.
+
+class Ad:
+    __slots__ = (
+        "id",
+        "user_id",
+        "category",
+        "price",
+        "dorm",
+        "description",
+        "photo_file_id",
+        "location",
+        "views",
+        "takes",
+        "created_at",
+        "expires_at",
+        "approved",
+        "score",
+    )
+
+    id: int
+    user_id: Optional[int]
+    category: Optional[str]
+    price: Optional[str]
+    dorm: Optional[int]
+    description: Optional[str]
+    photo_file_id: Optional[str]
+    location: Optional[str]
+    views: Optional[int]
+    takes: Optional[int]
+    created_at: datetime
+    expires_at: Optional[datetime]
+    approved: Optional[bool]
+    score: Optional[int]
+
+    def __init__(self, **fields: Any):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_row(cls, row: asyncpg.Record) -> "Ad":
+        return cls(**dict(row.items()))
+
+    def __repr__(self) -> str:
+        return f"Ad(id={self.id})"
+
+
+# лента: без location (его видно только после ❤️) и без счётчиков
+AD_FEED_COLS = "id, user_id, price, dorm, description, photo_file_id, created_at, expires_at"
+# мои объявления: всё, что видит продавец
+AD_MY_COLS = (
+    "id, category, price, dorm, location, description, photo_file_id, views, takes, created_at, expires_at, approved"
+)
+
+
+# ================= NAVIGATION =================
+# Склейка листания. Пять быстрых ➡️ по одной карточке — это пять
+# callback'ов с одним и тем же (старым) курсором; раньше каждый делал свой
+# запрос и свой edit_media, правки гонялись друг с другом и откатывались в
+# delete + answer_photo с дублями сообщений. Теперь первое нажатие по
+# сообщению (чат, message_id) — ведущее: ждёт NAV_DEBOUNCE_SEC, пока
+# остальные копят итоговый сдвиг (➡️ +1, ⬅️ −1) и сразу отвечают на
+# callback, потом проходит сдвиг соседями от своего курсора и один раз
+# рисует итоговую карточку. Нажатия, пришедшие во время отрисовки, — ещё
+# один круг от уже показанной позиции. Сдвиг 0 — ничего не рисуем; список
+# кончился посреди сдвига — рисуем последнюю карточку до края.
+
+class _NavWindow:
+    __slots__ = ("offset",)
+
+    def __init__(self, offset: int) -> None:
+        self.offset = offset
+
+
+class NavCoalescer:
+    def __init__(self, debounce: float, max_step: int) -> None:
+        self.debounce = debounce
+        self.max_step = max_step
+        self._windows: dict[tuple[int, int], _NavWindow] = {}
+
+    async def navigate(
+        self,
+        call: CallbackQuery,
+        step: int,
+        start: Ad,
+        neighbour: Callable[[Ad, bool], Awaitable[Optional[Ad]]],
+        show: Callable[[Ad], Awaitable[bool]],
+        empty: str,
+    ) -> None:
+        # neighbour(ad, forward) — соседняя карточка (forward = ➡️);
+        # show(ad) -> False, если сообщение пришлось заменить новым
+        key = (call.message.chat.id, call.message.message_id)
+        window = self._windows.get(key)
+        if window is not None:
+            window.offset += step
+            _nav_coalesced.inc()
+            await call.answer()
+            return
+
+        window = self._windows[key] = _NavWindow(step)
+        pos = start
+        try:
+            await asyncio.sleep(self.debounce)
+            while window.offset:
+                offset, window.offset = window.offset, 0
+                moved = False
+                for _ in range(min(abs(offset), self.max_step)):
+                    nxt = await neighbour(pos, offset > 0)
+                    if nxt is None:
+                        # край списка посреди сдвига — встаём на последнюю
+                        break
+                    pos, moved = nxt, True
+                if not moved:
+                    await call.answer(empty, show_alert=True)
+                    return
+                if not await show(pos):
+                    # старое сообщение удалено — его кнопки больше не листаем
+                    break
+        finally:
+            del self._windows[key]
         await call.answer()
-        return
 
-    _my_pos[call.from_user.id] = 0
-    await show_my_ad(call, ads, 0)
-    await call.answer()
 
+navigator = NavCoalescer(NAV_DEBOUNCE_SEC, FEED_SIZE)
 
-async def db_create_food_ad(user_id: int, data: dict) -> int:
-    async with db_pool().acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            INSERT INTO ads(user_id, category, photo_file_id, price, description, dorm, location)
-            VALUES($1, 'food', $2, $3, $4, $5, $6)
-            RETURNING id
+
+# ================= HOT FEED =================
+# Последние одобренные объявления категории держим в памяти компактными Ad.
+# Публикация/удаление правят ленту на месте, а фоновая сверка с Postgres
+# раз в FEED_RECONCILE_SEC подтягивает то, что поменялось в других процессах.
+# Соседи курсора внутри окна находятся без похода в базу; за окном —
+# один keyset-запрос.
+
+def _feed_key(created_at: datetime, ad_id: int) -> tuple[int, int]:
+    # ascending key == newest first
+    return -ts_us(created_at), -ad_id
+
+
+class HotFeed:
+    def __init__(self, size: int):
+        self.size = size
+        self._items: list[Ad] = []  # newest first
+        self._keys: list[tuple[int, int]] = []
+        # True, если в окне лежат вообще все объявления (их меньше size)
+        self.complete = False
+        # ближайший expires_at в окне: до него проверять сроки незачем
+        self._next_expiry: Optional[datetime] = None
+
+    def _drop_expired(self) -> None:
+        # janitor удаляет просроченные пачками и с задержкой, а feed_remove
+        # видит только свой процесс — окно само не отдаёт истёкшие
+        now = datetime.now(timezone.utc)
+        if self._next_expiry is None or self._next_expiry > now:
+            return
+        live = [i for i, ad in enumerate(self._items) if ad.expires_at is None or ad.expires_at > now]
+        self._items = [self._items[i] for i in live]
+        self._keys = [self._keys[i] for i in live]
+        self._next_expiry = min((ad.expires_at for ad in self._items if ad.expires_at), default=None)
+
+    def __len__(self) -> int:
+        self._drop_expired()
+        return len(self._items)
+
+    def first(self) -> Optional[Ad]:
+        self._drop_expired()
+        return self._items[0] if self._items else None
+
+    def last(self) -> Optional[Ad]:
+        self._drop_expired()
+        return self._items[-1] if self._items else None
+
+    def replace(self, items: list[Ad]) -> None:
+        self._items = items[: self.size]
+        self._keys = [_feed_key(ad.created_at, ad.id) for ad in self._items]
+        self.complete = len(items) < self.size
+        self._next_expiry = min((ad.expires_at for ad in self._items if ad.expires_at), default=None)
+
+    def add(self, ad: Ad) -> None:
+        key = _feed_key(ad.created_at, ad.id)
+        pos = bisect_left(self._keys, key)
+        if pos < len(self._keys) and self._keys[pos] == key:
+            return
+        if pos >= self.size:
+            return
+        self._items.insert(pos, ad)
+        self._keys.insert(pos, key)
+        if ad.expires_at is not None and (self._next_expiry is None or ad.expires_at < self._next_expiry):
+            self._next_expiry = ad.expires_at
+        if len(self._items) > self.size:
+            self._items.pop()
+            self._keys.pop()
+            self.complete = False
+
+    def remove(self, ad_id: int) -> None:
+        for pos, ad in enumerate(self._items):
+            if ad.id == ad_id:
+                del self._items[pos]
+                del self._keys[pos]
+                return
+
+    def neighbour(self, created_at: datetime, ad_id: int, older: bool) -> Any:
+        # Ad — сосед найден; None — соседа точно нет;
+        # _MISSING — окно не покрывает этот участок, нужен запрос в базу
+        self._drop_expired()
+        key = _feed_key(created_at, ad_id)
+        if older:
+            pos = bisect_right(self._keys, key)
+            if pos < len(self._items):
+                return self._items[pos]
+            return None if self.complete else _MISSING
+        if not self.complete and (not self._keys or key > self._keys[-1]):
+            return _MISSING
+        pos = bisect_left(self._keys, key) - 1
+        return self._items[pos] if pos >= 0 else None
+
+
+
+# ================= ENGAGEMENT =================
+# Показы и «Забрать» копятся в памяти и раз в STATS_FLUSH_SEC уходят в базу
+# одной транзакцией: ads.views/takes + дневные срезы по объявлению и общаге.
+# Листание ленты при этом не превращается в запись на каждый клик.
+
+class EngagementBuffer:
+    def __init__(self) -> None:
+        # ad_id -> [dorm, views, takes]
+        self._pending: dict[int, list] = {}
+
+    def _slot(self, ad_id: int, dorm: Optional[int]) -> list:
+        slot = self._pending.get(ad_id)
+        if slot is None:
+            slot = self._pending[ad_id] = [dorm, 0, 0]
+        return slot
+
+    def view(self, ad_id: int, dorm: Optional[int]) -> None:
+        self._slot(ad_id, dorm)[1] += 1
+
+    def take(self, ad_id: int, dorm: Optional[int]) -> None:
+        self._slot(ad_id, dorm)[2] += 1
+
+    def pending(self, ad_id: int) -> tuple[int, int]:
+        slot = self._pending.get(ad_id)
+        return (slot[1], slot[2]) if slot else (0, 0)
+
+    def _merge(self, batch: dict[int, list]) -> None:
+        for ad_id, (dorm, views, takes) in batch.items():
+            slot = self._slot(ad_id, dorm)
+            slot[1] += views
+            slot[2] += takes
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+
+        ids = list(batch)
+        dorms = [batch[i][0] for i in ids]
+        views = [batch[i][1] for i in ids]
+        takes = [batch[i][2] for i in ids]
+        try:
+            async with db_acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(
+                        """
+                        UPDATE ads a
+                        SET views=a.views+v.views, takes=a.takes+v.takes, engaged_at=NOW()
+                        FROM unnest($1::bigint[], $2::int[], $3::int[]) AS v(id, views, takes)
+                        WHERE a.id=v.id
+                        """,
+                        ids,
+                        views,
+                        takes,
+                    )
+                    await conn.execute(
+                        """
+                        INSERT INTO ad_stats_daily(day, ad_id, views, takes)
+                        SELECT CURRENT_DATE, v.id, v.views, v.takes
+                        FROM unnest($1::bigint[], $2::int[], $3::int[]) AS v(id, views, takes)
+                        JOIN ads a ON a.id=v.id
+                        ON CONFLICT (day, ad_id) DO UPDATE
+                        SET views=ad_stats_daily.views+EXCLUDED.views,
+                            takes=ad_stats_daily.takes+EXCLUDED.takes
+                        """,
+                        ids,
+                        views,
+                        takes,
+                    )
+                    await conn.execute(
+                        """
+                        INSERT INTO dorm_stats_daily(day, dorm, views, takes)
+                        SELECT CURRENT_DATE, v.dorm, SUM(v.views), SUM(v.takes)
+                        FROM unnest($1::int[], $2::int[], $3::int[]) AS v(dorm, views, takes)
+                        WHERE v.dorm IS NOT NULL
+                        GROUP BY v.dorm
+                        ON CONFLICT (day, dorm) DO UPDATE
+                        SET views=dorm_stats_daily.views+EXCLUDED.views,
+                            takes=dorm_stats_daily.takes+EXCLUDED.takes
+                        """,
+                        dorms,
+                        views,
+                        takes,
+                    )
+        except Exception:
+            self._merge(batch)
+            raise
+
+    async def flusher(self) -> None:
+        while True:
+            await asyncio.sleep(STATS_FLUSH_SEC)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("[stats] flush failed")
+
+
+engagement = EngagementBuffer()
+
+
+# ================= CATEGORIES =================
+# Разделы объявлений (еда, барахолка, учёба) — записи в CATEGORIES, а не
+# копии хендлеров. Категория объявляет поля анкеты с валидаторами, шаблоны
+# карточки и превью, кнопку «забрать» и срок жизни; листание, создание,
+# поиск, рейтинг и обмен контактами у всех общие.
+#   * callback_data: "<key>_<action>[:payload]" (food_next:<cursor>,
+#     market_take:42), раздел — "menu_<key>"; фильтр CategoryCallback
+#     кладёт в хендлер cat и payload;
+#   * у каждой категории свои prepared-запросы с категорией литералом,
+#     чтобы планировщик брал её частичный индекс ads_feed_<key>_idx
+#     (новая категория = запись в CATEGORIES + индекс в миграции);
+#   * у каждой своя HotFeed — стрелки листают окно в памяти, как у еды.
+
+class AdField:
+    __slots__ = ("name", "prompt", "parse")
+
+    def __init__(self, name: str, prompt: str, parse: Callable[[Message], Any]):
+        self.name = name  # колонка ads и ключ в данных FSM
+        self.prompt = prompt
+        # ValueError(текст для юзера) — переспросить
+        self.parse = parse
+
+
+def photo_field(prompt: str) -> AdField:
+    def parse(message: Message) -> str:
+        if not message.photo:
+            raise ValueError("Нужно отправить *фото* 🙂")
+        return message.photo[-1].file_id
+
+    return AdField("photo_file_id", prompt, parse)
+
+
+def text_field(name: str, prompt: str, error: str, min_len: int = 1, max_len: int = 1000) -> AdField:
+    def parse(message: Message) -> str:
+        text = (message.text or "").strip()
+        if not min_len <= len(text) <= max_len:
+            raise ValueError(error)
+        return text
+
+    return AdField(name, prompt, parse)
+
+
+def dorm_field(prompt: str = "🏢 Какая общага? (цифра, например 3)") -> AdField:
+    def parse(message: Message) -> int:
+        try:
+            dorm = int((message.text or "").strip())
+        except ValueError:
+            raise ValueError("Нужно число 🙂") from None
+        if dorm < 0 or dorm > 100:
+            raise ValueError("Слишком странное число 😅")
+        return dorm
+
+    return AdField("dorm", prompt, parse)
+
+
+class _Blank(dict):
+    def __missing__(self, key: str) -> str:
+        return ""
+
+
+def fill(template: str, values: Mapping[str, Any]) -> str:
+    return template.format_map(_Blank({k: v for k, v in values.items() if v is not None}))
+
+
+class Category:
+    def __init__(
+        self,
+        key: str,
+        title: str,
+        section: str,
+        fields: list[AdField],
+        card: str,
+        preview: str,
+        take_text: str,
+        ttl: timedelta,
+    ):
+        self.key = key
+        self.title = title
+        self.section = section
+        self.fields = fields
+        self.card = card
+        self.preview = preview
+        self.take_text = take_text
+        self.ttl = ttl
+        self.feed = HotFeed(FEED_SIZE)
+
+        where = f"category='{key}' AND approved=TRUE AND expires_at > NOW()"
+        self.q_list = query(
+            f"{key}_list",
+            f"""
+            SELECT {AD_FEED_COLS} FROM ads
+            WHERE {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT $1
             """,
-            user_id,
-            data.get("photo"),
-            data.get("price"),
-            data.get("description"),
-            data.get("dorm"),
-            data.get("location"),
         )
-        return int(row["id"])
+        # older -> query
+        self.q_neighbour = {
+            True: query(
+                f"{key}_older",
+                f"""
+                SELECT {AD_FEED_COLS} FROM ads
+                WHERE {where} AND (created_at, id) < ($1, $2)
+                ORDER BY created_at DESC, id DESC
+                LIMIT 1
+                """,
+            ),
+            False: query(
+                f"{key}_newer",
+                f"""
+                SELECT {AD_FEED_COLS} FROM ads
+                WHERE {where} AND (created_at, id) > ($1, $2)
+                ORDER BY created_at, id
+                LIMIT 1
+                """,
+            ),
+        }
+        # oldest -> query
+        self.q_edge = {
+            True: query(
+                f"{key}_oldest",
+                f"SELECT {AD_FEED_COLS} FROM ads WHERE {where} ORDER BY created_at, id LIMIT 1",
+            ),
+            False: query(
+                f"{key}_newest",
+                f"SELECT {AD_FEED_COLS} FROM ads WHERE {where} ORDER BY created_at DESC, id DESC LIMIT 1",
+            ),
+        }
+
+    def __repr__(self) -> str:
+        return f"Category({self.key})"
+
+
+CATEGORIES: dict[str, Category] = {
+    c.key: c
+    for c in (
+        Category(
+            key="food",
+            title="🍔 Еда",
+            section="🍔 *Раздел: Еда*\n\nВыбери действие:",
+            fields=[
+                photo_field("📸 Пришли *фото* еды одним сообщением."),
+                text_field("price", "💰 Напиши цену (пример: 150 или 100-200)",
+                           "Цена выглядит странно. Напиши короче 🙂", max_len=64),
+                text_field("description", "📝 Опиши еду (1–5 строк)", "Напиши чуть подробнее 🙂", min_len=3),
+                dorm_field(),
+                text_field("location", "📍 Где можно забрать еду? (пример: на тумбе, в кубаре)",
+                           "Укажи место чуть точнее 🙂", min_len=2),
+            ],
+            card=(
+                "🍔 *Еда*\n\n"
+                "💰 Цена: *{price}*\n"
+                "🏢 Общага: *{dorm}*\n"
+                "📍 Место: *после нажатия ❤️*\n\n"
+                "{description}\n"
+                "\n🆔 ID: `{id}`"
+            ),
+            preview=(
+                "✅ *Проверь объявление:*\n\n"
+                "💰 Цена: *{price}*\n"
+                "🏢 Общага: *{dorm}*\n"
+                "📍 Место: *{location}*\n\n"
+                "📝 Описание:\n{description}\n"
+            ),
+            take_text="❤️ Забрать",
+            ttl=timedelta(hours=FOOD_TTL_HOURS),
+        ),
+        Category(
+            key="market",
+            title="🛒 Барахолка",
+            section=(
+                "🛒 *Барахолка*\n\n"
+                "Здесь можно продавать и покупать вещи, технику и услуги.\n\n"
+                "Выбери действие:"
+            ),
+            fields=[
+                photo_field("📸 Пришли *фото* вещи одним сообщением."),
+                text_field("description", "📝 Что продаёшь? Состояние, размер — всё важное",
+                           "Напиши чуть подробнее 🙂", min_len=3),
+                text_field("price", "💰 Напиши цену (пример: 500, 1000-1500 или «договорная»)",
+                           "Цена выглядит странно. Напиши короче 🙂", max_len=64),
+                dorm_field(),
+                text_field("location", "📍 Где можно посмотреть и забрать? (пример: 3 этаж, 312)",
+                           "Укажи место чуть точнее 🙂", min_len=2),
+            ],
+            card=(
+                "🛒 *Барахолка*\n\n"
+                "💰 Цена: *{price}*\n"
+                "🏢 Общага: *{dorm}*\n"
+                "📍 Место: *после нажатия 🤝*\n\n"
+                "{description}\n"
+                "\n🆔 ID: `{id}`"
+            ),
+            preview=(
+                "✅ *Проверь объявление:*\n\n"
+                "💰 Цена: *{price}*\n"
+                "🏢 Общага: *{dorm}*\n"
+                "📍 Место: *{location}*\n\n"
+                "📝 Описание:\n{description}\n"
+            ),
+            take_text="🤝 Хочу",
+            ttl=timedelta(days=MARKET_TTL_DAYS),
+        ),
+        Category(
+            key="study",
+            title="📚 Учёба",
+            section=(
+                "📚 *Учёба*\n\n"
+                "Репетиторы, помощь с курсовыми, конспекты.\n\n"
+                "Выбери действие:"
+            ),
+            fields=[
+                text_field("description", "📝 Что предлагаешь или ищешь? Предмет, формат",
+                           "Напиши чуть подробнее 🙂", min_len=3),
+                text_field("price", "💰 Напиши цену (пример: 500/час или «договорная»)",
+                           "Цена выглядит странно. Напиши короче 🙂", max_len=64),
+                dorm_field(),
+            ],
+            card=(
+                "📚 *Учёба*\n\n"
+                "💰 Цена: *{price}*\n"
+                "🏢 Общага: *{dorm}*\n\n"
+                "{description}\n"
+                "\n🆔 ID: `{id}`"
+            ),
+            preview=(
+                "✅ *Проверь объявление:*\n\n"
+                "💰 Цена: *{price}*\n"
+                "🏢 Общага: *{dorm}*\n\n"
+                "📝 Описание:\n{description}\n"
+            ),
+            take_text="✍️ Написать",
+            ttl=timedelta(days=STUDY_TTL_DAYS),
+        ),
+    )
+}
+
+gauge("gvf_feed_size", "Ads held in the hot feeds", lambda: sum(len(c.feed) for c in CATEGORIES.values()))
+
+
+class CategoryCallback(Filter):
+    # "<key>_<action>[:payload]" / "menu_<key>" -> cat, action, payload в хендлер
+    def __init__(self, *actions: str):
+        self.actions = actions
+
+    async def __call__(self, call: CallbackQuery) -> Union[bool, dict[str, Any]]:
+        head, _, payload = (call.data or "").partition(":")
+        if head.startswith("menu_"):
+            key, action = head[5:], "menu"
+        else:
+            key, _, action = head.partition("_")
+        cat = CATEGORIES.get(key)
+        if cat is None or action not in self.actions:
+            return False
+        return {"cat": cat, "action": action, "payload": payload}
+
+
+# ================= ADS =================
+
+# повтор с тем же idem_key ничего не вставляет и отдаёт уже созданное
+# объявление (created=FALSE)
+Q_AD_CREATE = query(
+    "ad_create",
+    """
+    WITH ins AS (
+        INSERT INTO ads(user_id, category, photo_file_id, price, description, dorm, location, expires_at, approved,
+                        approved_at, idem_key)
+        VALUES($1, $2, $3, $4, $5, $6, $7, NOW() + $8::interval, $9, CASE WHEN $9 THEN NOW() END, $10)
+        ON CONFLICT (idem_key) WHERE idem_key IS NOT NULL DO NOTHING
+        RETURNING id, approved, created_at, expires_at, TRUE AS created
+    )
+    SELECT * FROM ins
+    UNION ALL
+    SELECT id, approved, created_at, expires_at, FALSE FROM ads
+    WHERE idem_key = $10 AND NOT EXISTS (SELECT 1 FROM ins)
+    """,
+)
 
 
-async def db_list_food_ads() -> list[asyncpg.Record]:
-    async with db_pool().acquire() as conn:
-        return await conn.fetch(
-            "SELECT * FROM ads WHERE category='food' AND approved=TRUE ORDER BY created_at DESC LIMIT 50"
+async def db_create_ad(cat: Category, user_id: int, data: dict) -> Optional[tuple[int, bool]]:
+    row = await db_fetchrow(
+        Q_AD_CREATE,
+        user_id,
+        cat.key,
+        data.get("photo_file_id"),
+        data.get("price"),
+        data.get("description"),
+        data.get("dorm"),
+        data.get("location"),
+        cat.ttl,
+        not is_premod(),
+        f"{user_id}:{data['idem']}" if data.get("idem") else None,
+    )
+    if row is None:
+        # параллельная вставка с тем же ключом ещё не закоммичена
+        return None
+    ad_id = int(row["id"])
+    if row["created"] and row["approved"]:
+        cat.feed.add(
+            Ad(
+                id=ad_id,
+                user_id=user_id,
+                price=data.get("price"),
+                dorm=data.get("dorm"),
+                description=data.get("description"),
+                photo_file_id=data.get("photo_file_id"),
+                created_at=row["created_at"],
+                expires_at=row["expires_at"],
+            )
         )
+    return ad_id, row["approved"]
+
+
+async def feed_reload() -> None:
+    for cat in CATEGORIES.values():
+        rows = await db_fetch(cat.q_list, FEED_SIZE)
+        cat.feed.replace([Ad.from_row(r) for r in rows])
+
+
+async def feed_reconciler() -> None:
+    while True:
+        await asyncio.sleep(FEED_RECONCILE_SEC)
+        try:
+            await feed_reload()
+        except Exception:
+            logging.exception("[feed] reconcile failed")
+
+
+def feed_remove(ad_id: int) -> None:
+    for cat in CATEGORIES.values():
+        cat.feed.remove(ad_id)
+
+
+async def ad_neighbour(cat: Category, created_at: datetime, ad_id: int, older: bool) -> Optional[Ad]:
+    # сосед по ленте с переходом через край (как раньше по модулю)
+    ad = cat.feed.neighbour(created_at, ad_id, older)
+    if ad is _MISSING:
+        row = await db_fetchrow(cat.q_neighbour[older], created_at, ad_id)
+        ad = Ad.from_row(row) if row else None
+    if ad is not None:
+        return ad
+    return await ad_edge(cat, oldest=not older)
+
+
+async def ad_edge(cat: Category, oldest: bool) -> Optional[Ad]:
+    feed = cat.feed
+    if feed.complete or (feed and not oldest):
+        return feed.last() if oldest else feed.first()
+    row = await db_fetchrow(cat.q_edge[oldest])
+    return Ad.from_row(row) if row else None
+
+
+Q_AD_DELETE = query("ad_delete", "DELETE FROM ads WHERE id=$1 RETURNING id")
 
 
 async def db_delete_ad_admin(ad_id: int) -> bool:
-    async with db_pool().acquire() as conn:
-        res = await conn.execute("DELETE FROM ads WHERE id=$1", ad_id)
-        return res.endswith("1")
+    deleted = await db_fetchval(Q_AD_DELETE, ad_id)
+    feed_remove(ad_id)
+    return deleted is not None
+
+
+# first — ключ $3 вставлен этим вызовом (продавцу ещё не писали)
+Q_TAKE_CONTACTS = query(
+    "take_contacts",
+    """
+    WITH k AS (
+        INSERT INTO action_keys(key) VALUES($3)
+        ON CONFLICT DO NOTHING
+        RETURNING key
+    )
+    SELECT
+        a.user_id AS seller_id,
+        a.dorm,
+        a.location,
+        s.username AS seller_username,
+        s.phone AS seller_phone,
+        b.phone AS buyer_phone,
+        EXISTS (SELECT 1 FROM k) AS first
+    FROM ads a
+    JOIN users s ON s.user_id = a.user_id
+    LEFT JOIN users b ON b.user_id = $2
+    WHERE a.id = $1 AND a.expires_at > NOW()
+    """,
+)
 
 
-async def db_list_verified_users() -> list[asyncpg.Record]:
-    async with db_pool().acquire() as conn:
-        return await conn.fetch("SELECT user_id FROM users WHERE is_verified=TRUE")
+async def db_take_contacts(ad_id: int, buyer_id: int, key: str) -> Optional[asyncpg.Record]:
+    # всё для обмена контактами + отметка идемпотентности одним запросом
+    return await db_fetchrow(Q_TAKE_CONTACTS, ad_id, buyer_id, key)
 
 
-def food_view_ikb(ad_id: int) -> InlineKeyboardMarkup:
+def ad_view_ikb(cat: Category, ad: Ad, nav: str = "") -> InlineKeyboardMarkup:
+    # nav — вид листания: "" (лента), "r" (лента по общаге), "s" (поиск)
+    cursor = f"{ad.score}:{ad.id}" if nav == "r" else encode_cursor(ad.created_at, ad.id)
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="⬅️", callback_data="food_prev"),
-                InlineKeyboardButton(text="❤️ Забрать", callback_data=f"food_take:{ad_id}"),
-                InlineKeyboardButton(text="➡️", callback_data="food_next"),
+                InlineKeyboardButton(text="⬅️", callback_data=f"{cat.key}_{nav}prev:{cursor}"),
+                InlineKeyboardButton(text=cat.take_text, callback_data=f"{cat.key}_take:{ad.id}"),
+                InlineKeyboardButton(text="➡️", callback_data=f"{cat.key}_{nav}next:{cursor}"),
             ],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu_food")],
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"menu_{cat.key}")],
             [InlineKeyboardButton(text=HOME_TEXT, callback_data="menu_home")],
         ]
     )
 
-@router.callback_query(F.data.in_({"food_prev", "food_next"}))
-async def food_nav(call: CallbackQuery):
-    user = await db_get_user(call.from_user.id)
-    if not user or not user["is_verified"]:
-        await call.answer("Подтверди номер через ▶️ Начать", show_alert=True)
-        return
-
-    ads = await db_list_food_ads()
-    if not ads:
-        await call.answer("Пока нет объявлений", show_alert=True)
-        return
-
-    cur = _food_pos.get(call.from_user.id, 0)
-    if call.data == "food_next":
-        cur = (cur + 1) % len(ads)
-    else:
-        cur = (cur - 1) % len(ads)
-
-    await show_food_at(call, ads, cur)
-    await call.answer()
-# === FOOD SECTION KEYBOARDS ===
 
-def food_section_ikb() -> InlineKeyboardMarkup:
+def section_ikb(cat: Category) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="📋 Смотреть", callback_data="food_view"),
-                InlineKeyboardButton(text="➕ Добавить", callback_data="food_add"),
+                InlineKeyboardButton(text="📋 Смотреть", callback_data=f"{cat.key}_view"),
+                InlineKeyboardButton(text="➕ Добавить", callback_data=f"{cat.key}_add"),
             ],
+            [InlineKeyboardButton(text="🔎 Поиск", callback_data=f"{cat.key}_search")],
             [InlineKeyboardButton(text=HOME_TEXT, callback_data="menu_home")],
         ]
     )
 
 
-def food_cancel_ikb() -> InlineKeyboardMarkup:
+def cancel_ikb(cat: Category) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="food_cancel")]]
+        inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data=f"{cat.key}_cancel")]]
     )
 
 
-def food_confirm_ikb() -> InlineKeyboardMarkup:
+def confirm_ikb(cat: Category) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Опубликовать", callback_data="food_publish")],
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="food_cancel")],
+            [InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"{cat.key}_publish")],
+            [InlineKeyboardButton(text="❌ Отмена", callback_data=f"{cat.key}_cancel")],
         ]
     )
 
 
-def _fmt_food(ad: asyncpg.Record) -> str:
-    return (
-        "🍔 *Еда*\n\n"
-        f"💰 Цена: *{ad['price']}*\n"
-        f"🏢 Общага: *{ad['dorm']}*\n"
-        "📍 Место: *после нажатия ❤️*\n\n"
-        f"{ad['description'] or ''}\n"
-        f"\n🆔 ID: `{ad['id']}`"
-    )
-
-def _food_caption(ad: asyncpg.Record, idx: int, total: int) -> str:
-    return _fmt_food(ad) + f"\n\n_{idx+1}/{total}_"
-
+def _fmt_ad(cat: Category, ad: Ad) -> str:
+    return fill(cat.card, {name: getattr(ad, name) for name in Ad.__slots__})
 
-async def show_food_at(call: CallbackQuery, ads: list[asyncpg.Record], idx: int) -> None:
-    idx = max(0, min(idx, len(ads) - 1))
-    _food_pos[call.from_user.id] = idx
-    ad = ads[idx]
 
-    caption = _food_caption(ad, idx, len(ads))
-    ad_id = int(ad["id"])
-    photo_id = ad.get("photo_file_id")
+async def show_ad_at(call: CallbackQuery, cat: Category, ad: Ad, nav: str = "") -> bool:
+    # True — карточка показана правкой того же сообщения
+    engagement.view(ad.id, ad.dorm)
+    photo_id = ad.photo_file_id
 
-    # если текущее сообщение уже фото — пробуем edit_media
+    # фото -> фото: edit_media, текст -> текст: edit_text
     try:
         if call.message.photo and photo_id:
-            media = InputMediaPhoto(media=photo_id, caption=caption, parse_mode="Markdown")
-            await call.message.edit_media(media=media, reply_markup=food_view_ikb(ad_id))
-            return
+            media = InputMediaPhoto(media=photo_id, caption=_fmt_ad(cat, ad), parse_mode="Markdown")
+            await call.message.edit_media(media=media, reply_markup=ad_view_ikb(cat, ad, nav))
+            return True
+        if not call.message.photo and not photo_id:
+            await call.message.edit_text(
+                _fmt_ad(cat, ad), parse_mode="Markdown", reply_markup=ad_view_ikb(cat, ad, nav)
+            )
+            return True
+    except TelegramBadRequest as e:
+        # листание по кругу вернулось на ту же карточку
+        if "not modified" in str(e):
+            return True
+        swallowed("show_ad_at.edit")
     except Exception:
-        pass
+        swallowed("show_ad_at.edit")
 
-    # иначе удаляем старое и шлём новое фото
+    # иначе удаляем старое и шлём новое
     try:
         await call.message.delete()
     except Exception:
-        pass
+        swallowed("show_ad_at.delete")
 
-    if photo_id:
-        await call.message.answer_photo(
-            photo=photo_id,
-            caption=caption,
+    await send_ad(call.message, cat, ad, nav)
+    return False
+
+
+async def send_ad(message: Message, cat: Category, ad: Ad, nav: str = "") -> None:
+    if ad.photo_file_id:
+        await message.answer_photo(
+            photo=ad.photo_file_id,
+            caption=_fmt_ad(cat, ad),
             parse_mode="Markdown",
-            reply_markup=food_view_ikb(ad_id),
+            reply_markup=ad_view_ikb(cat, ad, nav),
         )
     else:
-        await call.message.answer(
-            caption,
+        await message.answer(
+            _fmt_ad(cat, ad),
             parse_mode="Markdown",
-            reply_markup=food_view_ikb(ad_id),
+            reply_markup=ad_view_ikb(cat, ad, nav),
         )
 
-# ================= FOOD FLOW =================
-
-
 
-# ==== FOOD SECTION MENU ====
-@router.callback_query(F.data == "menu_food")
-async def food_section(call: CallbackQuery):
-    user = await db_get_user(call.from_user.id)
-    if not user or not user["is_verified"]:
-        await call.answer("Подтверди номер через ▶️ Начать", show_alert=True)
-        return
-    if await db_is_tech_mode() and call.from_user.id != ADMIN_ID:
-        await call.answer("🛠 Техработы", show_alert=True)
+@router.callback_query(CategoryCallback("prev", "next"), flags={"verified": True})
+async def ad_nav(call: CallbackQuery, cat: Category, action: str, payload: str):
+    cursor = decode_cursor(payload)
+    if cursor is None:
+        # старые кнопки без курсора — начинаем с начала ленты
+        ad = await ad_edge(cat, oldest=False)
+        if not ad:
+            await call.answer("Пока нет объявлений", show_alert=True)
+            return
+        await show_ad_at(call, cat, ad)
+        await call.answer()
         return
 
-    await call.message.edit_text(
-        "🍔 *Раздел: Еда*\n\nВыбери действие:",
-        reply_markup=food_section_ikb(),
-        parse_mode="Markdown",
+    await navigator.navigate(
+        call,
+        1 if action == "next" else -1,
+        Ad(created_at=cursor[0], id=cursor[1]),
+        lambda ad, older: ad_neighbour(cat, ad.created_at, ad.id, older),
+        lambda ad: show_ad_at(call, cat, ad),
+        "Пока нет объявлений",
     )
+
+
+# ================= AD FLOW =================
+
+@router.callback_query(CategoryCallback("menu"), flags={"verified": True, "tech": True})
+async def ad_section(call: CallbackQuery, cat: Category):
+    try:
+        await call.message.edit_text(cat.section, reply_markup=section_ikb(cat), parse_mode="Markdown")
+    except Exception:
+        # «Назад» с карточки-фото
+        swallowed("ad_section.edit")
+        try:
+            await call.message.delete()
+        except Exception:
+            swallowed("ad_section.delete")
+        await call.message.answer(cat.section, reply_markup=section_ikb(cat), parse_mode="Markdown")
     await call.answer()
 
 
-# ==== FOOD VIEW LATEST ====
-@router.callback_query(F.data == "food_view")
-async def food_view(call: CallbackQuery):
-    user = await db_get_user(call.from_user.id)
-    if not user or not user["is_verified"]:
-        await call.answer("Подтверди номер через ▶️ Начать", show_alert=True)
-        return
-    if await db_is_tech_mode() and call.from_user.id != ADMIN_ID:
-        await call.answer("🛠 Техработы", show_alert=True)
-        return
+@router.callback_query(CategoryCallback("view"), flags={"verified": True, "tech": True})
+async def ad_view(call: CallbackQuery, cat: Category, user: Optional[asyncpg.Record]):
+    # общага известна — лента по рейтингу, иначе (или пока рейтинг не
+    # посчитан для этой общаги) — просто свежие
+    dorm = user["dorm"] if user else None
+    if dorm is not None:
+        ad = await rank_edge(cat, dorm, bottom=False)
+        if ad:
+            await show_ad_at(call, cat, ad, nav="r")
+            await call.answer()
+            return
 
-    ads = await db_list_food_ads()
-    if not ads:
+    ad = await ad_edge(cat, oldest=False)
+    if not ad:
         await call.message.edit_text(
             "😔 Пока нет объявлений.\n\nНажми ➕ Добавить и стань первым!",
-            reply_markup=food_section_ikb(),
+            reply_markup=section_ikb(cat),
         )
         await call.answer()
         return
 
-    await show_food_at(call, ads, 0)
+    await show_ad_at(call, cat, ad)
     await call.answer()
 
 
+# ==== AD ADD FLOW (FSM) ====
+# Анкета идёт по cat.fields: в данных FSM категория ("cat"), номер шага
+# ("step") и уже введённые поля под именами колонок ads.
 
+@router.callback_query(CategoryCallback("add"), flags={"verified": True, "tech": True})
+async def ad_add_start(call: CallbackQuery, cat: Category, state: FSMContext):
+    # idem — токен анкеты: сколько раз ни жми «Опубликовать», объявление одно
+    await state.set_data({"cat": cat.key, "step": 0, "idem": secrets.token_hex(8)})
+    await state.set_state(AdCreate.field)
 
-# ==== FOOD ADD FLOW (FSM) ====
-@router.callback_query(F.data == "food_add")
-async def food_add_start(call: CallbackQuery, state: FSMContext):
-    user = await db_get_user(call.from_user.id)
-    if not user or not user["is_verified"]:
-        await call.answer("Подтверди номер через ▶️ Начать", show_alert=True)
-        return
-    if await db_is_tech_mode() and call.from_user.id != ADMIN_ID:
-        await call.answer("🛠 Техработы", show_alert=True)
-        return
-
-    await state.clear()
-    await state.set_state(FoodAdd.photo)
-
-    await call.message.answer(
-        "📸 Пришли *фото* еды одним сообщением.",
-        parse_mode="Markdown",
-        reply_markup=food_cancel_ikb(),
-    )
+    await call.message.answer(cat.fields[0].prompt, parse_mode="Markdown", reply_markup=cancel_ikb(cat))
     await call.answer()
 
 
-@router.callback_query(F.data == "food_cancel")
-async def food_cancel(call: CallbackQuery, state: FSMContext):
+@router.callback_query(CategoryCallback("cancel"))
+async def ad_cancel(call: CallbackQuery, cat: Category, state: FSMContext):
     await state.clear()
     try:
-        await call.message.edit_text(
-            "🍔 *Раздел: Еда*\n\nВыбери действие:",
-            reply_markup=food_section_ikb(),
-            parse_mode="Markdown",
-        )
+        await call.message.edit_text(cat.section, reply_markup=section_ikb(cat), parse_mode="Markdown")
     except Exception:
-        await call.message.answer("Ок, отменил ✅", reply_markup=food_section_ikb())
+        swallowed("ad_cancel.edit")
+        await call.message.answer("Ок, отменил ✅", reply_markup=section_ikb(cat))
     await call.answer("Отменено")
 
 
-@router.message(FoodAdd.photo, F.photo)
-async def food_add_photo(message: Message, state: FSMContext):
-    await state.update_data(photo=message.photo[-1].file_id)
-    await state.set_state(FoodAdd.price)
-    await message.answer("💰 Напиши цену (пример: 150 или 100-200)", reply_markup=food_cancel_ikb())
+@router.message(AdCreate.field)
+async def ad_add_field(message: Message, state: FSMContext):
+    data = await state.get_data()
+    cat = CATEGORIES.get(data.get("cat"))
+    step = data.get("step", 0)
+    if cat is None or step >= len(cat.fields):
+        await state.clear()
+        await message.answer("⚠️ Данные не найдены, попробуй заново.", reply_markup=main_menu_ikb())
+        return
+
+    field = cat.fields[step]
+    try:
+        value = field.parse(message)
+    except ValueError as e:
+        await message.answer(str(e), parse_mode="Markdown", reply_markup=cancel_ikb(cat))
+        return
+
+    if field.name == "dorm":
+        await db_set_user_dorm(message.from_user.id, value)
+
+    data[field.name] = value
+    data["step"] = step + 1
+    await state.set_data(data)
+    if step + 1 < len(cat.fields):
+        # set_data пишется в базу отложенно, set_state — сразу: шаг не должен
+        # потеряться при рестарте или уйти устаревшим на соседнюю реплику
+        await state.set_state(AdCreate.field)
+        await message.answer(cat.fields[step + 1].prompt, parse_mode="Markdown", reply_markup=cancel_ikb(cat))
+        return
 
+    await state.set_state(AdCreate.confirm)
+    preview = fill(cat.preview, data)
+    if data.get("photo_file_id"):
+        await message.answer_photo(
+            photo=data["photo_file_id"],
+            caption=preview,
+            parse_mode="Markdown",
+            reply_markup=confirm_ikb(cat),
+        )
+    else:
+        await message.answer(preview, parse_mode="Markdown", reply_markup=confirm_ikb(cat))
 
-@router.message(FoodAdd.photo)
-async def food_add_photo_wrong(message: Message):
-    await message.answer("Нужно отправить *фото* 🙂", parse_mode="Markdown", reply_markup=food_cancel_ikb())
 
+@router.callback_query(CategoryCallback("publish"), flags={"verified": True, "lock": True})
+async def ad_publish(call: CallbackQuery, cat: Category, state: FSMContext):
+    data = await state.get_data()
+    if data.get("cat") != cat.key or any(data.get(f.name) in (None, "") for f in cat.fields):
+        await state.clear()
+        await call.message.answer("⚠️ Данные не найдены, попробуй заново.", reply_markup=section_ikb(cat))
+        await call.answer()
+        return
 
-@router.message(FoodAdd.price)
-async def food_add_price(message: Message, state: FSMContext):
-    text = (message.text or "").strip()
-    if not text or len(text) > 64:
-        await message.answer("Цена выглядит странно. Напиши короче 🙂", reply_markup=food_cancel_ikb())
+    # админ узнаёт о новых объявлениях из сводки (review_digester)
+    created = await db_create_ad(cat, call.from_user.id, data)
+    if created is None:
+        await call.answer()
         return
-    await state.update_data(price=text)
-    await state.set_state(FoodAdd.description)
-    await message.answer("📝 Опиши еду (1–5 строк)", reply_markup=food_cancel_ikb())
+    ad_id, approved = created
+    await state.clear()
 
+    if approved:
+        text = f"🎉 Готово! Объявление опубликовано ✅\n🆔 ID: `{ad_id}`"
+    else:
+        text = f"🧐 Объявление отправлено на модерацию — напишу, когда его одобрят.\n🆔 ID: `{ad_id}`"
+    await call.message.answer(text, parse_mode="Markdown", reply_markup=section_ikb(cat))
+    await call.answer("Опубликовано" if approved else "На модерации")
 
-@router.message(FoodAdd.description)
-async def food_add_desc(message: Message, state: FSMContext):
-    text = (message.text or "").strip()
-    if len(text) < 3:
-        await message.answer("Напиши чуть подробнее 🙂", reply_markup=food_cancel_ikb())
-        return
-    await state.update_data(description=text)
-    await state.set_state(FoodAdd.dorm)
-    await message.answer("🏢 Какая общага? (цифра, например 3)", reply_markup=food_cancel_ikb())
 
+@router.callback_query(CategoryCallback("take"), flags={"verified": True, "lock": True})
+async def ad_take(call: CallbackQuery, cat: Category, payload: str):
+    ad_id = int(payload)
+    # одна карточка — одно уведомление продавцу, даже если повтор пришёл
+    # в другую реплику или после ACTION_DEDUP_SEC
+    key = f"take:{call.from_user.id}:{call.message.message_id}:{ad_id}"
+    contacts = await db_take_contacts(ad_id, call.from_user.id, key)
 
-@router.message(FoodAdd.dorm)
-async def food_add_dorm(message: Message, state: FSMContext):
-    try:
-        dorm = int((message.text or "").strip())
-    except ValueError:
-        await message.answer("Нужно число 🙂", reply_markup=food_cancel_ikb())
-        return
-    if dorm < 0 or dorm > 100:
-        await message.answer("Слишком странное число 😅", reply_markup=food_cancel_ikb())
+    if not contacts:
+        await call.answer("Не найдено", show_alert=True)
         return
-    await state.update_data(dorm=dorm)
-    await state.set_state(FoodAdd.location)
-    await message.answer("📍 Где можно забрать еду? (пример: на тумбе, в кубаре", reply_markup=food_cancel_ikb())
 
+    seller_id = int(contacts["seller_id"])
+    seller_username = contacts["seller_username"]
+    buyer_username = call.from_user.username
 
-@router.message(FoodAdd.location)
-async def food_add_location(message: Message, state: FSMContext):
-    text = (message.text or "").strip()
-    if len(text) < 2:
-        await message.answer("Укажи место чуть точнее 🙂", reply_markup=food_cancel_ikb())
-        return
+    seller_phone = contacts["seller_phone"] or "—"
+    buyer_phone = contacts["buyer_phone"] or "—"
 
-    await state.update_data(location=text)
-    data = await state.get_data()
+    # buyer -> seller
+    kb_buyer = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="💬 Написать продавцу", url=chat_url(seller_id, seller_username))]
+        ]
+    )
 
-    preview = (
-        "✅ *Проверь объявление:*\n\n"
-        f"💰 Цена: *{data.get('price')}*\n"
-        f"🏢 Общага: *{data.get('dorm')}*\n"
-        f"📍 Место: *{data.get('location')}*\n\n"
-        f"📝 Описание:\n{data.get('description')}\n"
+    # seller notification — в фоне, через общую очередь
+    kb_seller = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="💬 Написать покупателю", url=chat_url(call.from_user.id, buyer_username))]
+        ]
     )
 
-    await state.set_state(FoodAdd.confirm)
-    await message.answer_photo(
-        photo=data.get("photo"),
-        caption=preview,
-        parse_mode="Markdown",
-        reply_markup=food_confirm_ikb(),
+    if contacts["first"]:
+        engagement.take(ad_id, contacts["dorm"])
+        spawn(
+            send_later(
+                call.bot,
+                seller_id,
+                "❤️ *Твоё объявление заинтересовало покупателя!*\n\n"
+                f"👤 {user_link_md(call.from_user.id, buyer_username, 'Покупатель')}\n"
+                f"📞 `{buyer_phone}`\n\n"
+                f"🆔 Объявление: `{ad_id}`",
+                priority=PRIORITY_INTERACTIVE,
+                reply_markup=kb_seller,
+                parse_mode="Markdown",
+            )
+        )
+
+    location = f"📍 Где забрать: *{contacts['location']}*\n" if contacts["location"] else ""
+    await asyncio.gather(
+        call.message.answer(
+            "❤️ *Контакты продавца*\n\n"
+            f"{location}"
+            f"📞 `{seller_phone}`\n"
+            f"👤 {('@' + seller_username) if seller_username else 'без username'}",
+            reply_markup=kb_buyer,
+            parse_mode="Markdown",
+        ),
+        call.answer("Контакты отправлены"),
     )
 
 
-@router.callback_query(F.data == "food_publish")
-async def food_publish(call: CallbackQuery, state: FSMContext):
-    user = await db_get_user(call.from_user.id)
-    if not user or not user["is_verified"]:
-        await call.answer("Подтверди номер через ▶️ Начать", show_alert=True)
-        return
+# ================= SEARCH =================
+# Текст + фильтры общаги и цены одной строкой: «пельмени общага 3 до 200».
+# Фильтр лежит в данных FSM (в callback_data не влезает), стрелки
+# <key>_sprev/<key>_snext листают результаты keyset-курсором, как ленту.
+# Текст ищется по ads.search (GIN), общага — по (dorm, created_at).
+# SQL собирается под набор заданных фильтров: без `$n IS NULL OR ...`,
+# чтобы у каждого варианта был свой план с нужным индексом.
+
+_SEARCH_DORM = re.compile(r"\b(?:общага|общ|dorm)\s*№?\s*(\d{1,3})\b", re.IGNORECASE)
+_SEARCH_RANGE = re.compile(r"\b(\d{1,6})\s*[-–]\s*(\d{1,6})\b")
+_SEARCH_MIN = re.compile(r"\bот\s*(\d{1,6})\b", re.IGNORECASE)
+_SEARCH_MAX = re.compile(r"\bдо\s*(\d{1,6})\b", re.IGNORECASE)
+
+
+def parse_search(text: str) -> dict[str, Any]:
+    f: dict[str, Any] = {"q": None, "dorm": None, "lo": None, "hi": None}
+
+    def take(pattern: re.Pattern, text: str) -> tuple[Optional[re.Match], str]:
+        m = pattern.search(text)
+        return (m, text[: m.start()] + " " + text[m.end():]) if m else (None, text)
+
+    m, text = take(_SEARCH_DORM, text)
+    if m:
+        f["dorm"] = int(m.group(1))
+    m, text = take(_SEARCH_RANGE, text)
+    if m:
+        f["lo"], f["hi"] = sorted((int(m.group(1)), int(m.group(2))))
+    m, text = take(_SEARCH_MIN, text)
+    if m:
+        f["lo"] = int(m.group(1))
+    m, text = take(_SEARCH_MAX, text)
+    if m:
+        f["hi"] = int(m.group(1))
+    f["q"] = " ".join(text.split())[:100] or None
+    return f
+
+
+def _fmt_search(f: dict[str, Any]) -> str:
+    parts = []
+    if f.get("q"):
+        parts.append(f"«{f['q']}»")
+    if f.get("dorm") is not None:
+        parts.append(f"общага {f['dorm']}")
+    if f.get("lo") is not None and f.get("hi") is not None:
+        parts.append(f"{f['lo']}–{f['hi']} ₽")
+    elif f.get("lo") is not None:
+        parts.append(f"от {f['lo']} ₽")
+    elif f.get("hi") is not None:
+        parts.append(f"до {f['hi']} ₽")
+    return ", ".join(parts)
+
+
+_SEARCH_CONDS = {
+    "q": "search @@ websearch_to_tsquery('russian', ${})",
+    "dorm": "dorm = ${}",
+    "lo": "price_num >= ${}",
+    "hi": "price_num <= ${}",
+}
+
+
+@cache
+def _search_query(cat_key: str, keys: tuple[str, ...], mode: str) -> str:
+    # mode: older / newer (сосед курсора), oldest / newest (край выборки)
+    where = [f"category='{cat_key}'", "approved=TRUE", "expires_at > NOW()"]
+    where += [_SEARCH_CONDS[k].format(i) for i, k in enumerate(keys, 1)]
+    n = len(keys)
+    if mode == "older":
+        where.append(f"(created_at, id) < (${n + 1}, ${n + 2})")
+    elif mode == "newer":
+        where.append(f"(created_at, id) > (${n + 1}, ${n + 2})")
+    order = "created_at DESC, id DESC" if mode in ("older", "newest") else "created_at, id"
+    return query(
+        f"{cat_key}_search_{mode}_{'_'.join(keys) or 'all'}",
+        f"""
+        SELECT {AD_FEED_COLS} FROM ads
+        WHERE {' AND '.join(where)}
+        ORDER BY {order}
+        LIMIT 1
+        """,
+    )
 
-    data = await state.get_data()
-    required = ["photo", "price", "description", "dorm", "location"]
-    if not all(k in data and data[k] for k in required):
-        await state.clear()
-        await call.message.answer("⚠️ Данные не найдены, попробуй заново.", reply_markup=food_section_ikb())
-        await call.answer()
-        return
 
-    ad_id = await db_create_food_ad(call.from_user.id, data)
+async def db_search_ads(cat: Category, f: dict[str, Any], mode: str, cursor: tuple = ()) -> Optional[Ad]:
+    keys = tuple(k for k in _SEARCH_CONDS if f.get(k) is not None)
+    row = await db_fetchrow(_search_query(cat.key, keys, mode), *(f[k] for k in keys), *cursor)
+    return Ad.from_row(row) if row else None
 
-    # Notify admin about new post
-    if ADMIN_ID:
-        try:
-            await call.bot.send_message(
-                ADMIN_ID,
-                "🆕 Новое объявление (Еда) #{}\n".format(ad_id)
-                + "От: {}\n".format(user_link_md(call.from_user.id, call.from_user.username, "продавец"))
-                + "Цена: {}\n".format(data.get("price"))
-                + "Общага: {}\n".format(data.get("dorm"))
-                + "Место: {}\n\n".format(data.get("location"))
-                + (data.get("description") or ""),
-                parse_mode="Markdown",
-            )
-        except Exception:
-            pass
 
-    _food_pos[call.from_user.id] = 0
-    await state.clear()
+async def search_neighbour(
+    cat: Category, f: dict[str, Any], created_at: datetime, ad_id: int, older: bool
+) -> Optional[Ad]:
+    # как ad_neighbour: за краем — на другой конец выдачи
+    ad = await db_search_ads(cat, f, "older" if older else "newer", (created_at, ad_id))
+    if ad is not None:
+        return ad
+    return await db_search_ads(cat, f, "newest" if older else "oldest")
 
+
+@router.callback_query(CategoryCallback("search"), flags={"verified": True, "tech": True})
+async def ad_search_start(call: CallbackQuery, cat: Category, state: FSMContext):
+    await state.set_state(AdSearch.query)
+    await state.update_data(search_cat=cat.key)
     await call.message.answer(
-        f"🎉 Готово! Объявление опубликовано ✅\n🆔 ID: `{ad_id}`",
+        "🔎 Что ищем?\n\n"
+        "Напиши текст и, если нужно, фильтры:\n"
+        "• `общага 3`\n"
+        "• `до 200`, `от 100`, `100-300`\n\n"
+        "Например: `пельмени общага 3 до 200`",
         parse_mode="Markdown",
-        reply_markup=food_section_ikb(),
+        reply_markup=cancel_ikb(cat),
     )
-    await call.answer("Опубликовано")
-
+    await call.answer()
 
 
-@router.callback_query(F.data.startswith("food_take:"))
-async def food_take(call: CallbackQuery):
-    user = await db_get_user(call.from_user.id)
-    if not user or not user["is_verified"]:
-        await call.answer("Подтверди номер через ▶️ Начать", show_alert=True)
+@router.message(AdSearch.query)
+async def ad_search_query(message: Message, state: FSMContext):
+    cat = CATEGORIES.get((await state.get_data()).get("search_cat"), CATEGORIES["food"])
+    f = parse_search(message.text or "")
+    if not any(v is not None for v in f.values()):
+        await message.answer("Напиши, что ищешь 🙂", reply_markup=cancel_ikb(cat))
         return
 
-    ad_id = int(call.data.split(":")[1])
-    async with db_pool().acquire() as conn:
-        ad = await conn.fetchrow("SELECT * FROM ads WHERE id=$1", ad_id)
+    await state.set_state(None)
+    await state.update_data(search=f)
 
+    ad = await db_search_ads(cat, f, "newest")
     if not ad:
-        await call.answer("Не найдено", show_alert=True)
+        await message.answer(f"😔 Ничего не нашлось: {_fmt_search(f)}", reply_markup=section_ikb(cat))
         return
 
-    seller_id = int(ad["user_id"])
-    seller = await db_get_user(seller_id)
-
-    buyer = await db_get_user(call.from_user.id)
+    engagement.view(ad.id, ad.dorm)
+    await send_ad(message, cat, ad, nav="s")
 
-    seller_username = seller["username"] if seller else None
-    buyer_username = call.from_user.username
 
-    seller_phone = seller["phone"] if seller else "—"
-    buyer_phone = buyer["phone"] if buyer else "—"
+@router.callback_query(CategoryCallback("sprev", "snext"), flags={"verified": True})
+async def ad_search_nav(call: CallbackQuery, cat: Category, action: str, payload: str, state: FSMContext):
+    data = await state.get_data()
+    f = data.get("search") if data.get("search_cat") == cat.key else None
+    cursor = decode_cursor(payload)
+    if not f or cursor is None:
+        await call.answer("Поиск устарел — начни заново 🔎", show_alert=True)
+        return
 
-    # buyer -> seller
-    kb_buyer = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="💬 Написать продавцу", url=chat_url(seller_id, seller_username))]
-        ]
+    await navigator.navigate(
+        call,
+        1 if action == "snext" else -1,
+        Ad(created_at=cursor[0], id=cursor[1]),
+        lambda ad, older: search_neighbour(cat, f, ad.created_at, ad.id, older),
+        lambda ad: show_ad_at(call, cat, ad, nav="s"),
+        "Ничего не нашлось",
     )
 
-    await call.message.answer(
-        "❤️ *Контакты продавца*\n\n"
-        f"📍 Где забрать: *{ad['location']}*\n"
-        f"📞 `{seller_phone}`\n"
-        f"👤 {('@' + seller_username) if seller_username else 'без username'}",
-        reply_markup=kb_buyer,
-        parse_mode="Markdown",
-    )
 
-    # seller notification
-    kb_seller = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="💬 Написать покупателю", url=chat_url(call.from_user.id, buyer_username))]
-        ]
-    )
+# ================= RANKED FEED =================
+# Лента «сначала своя общага». Очки считаются заранее в feed_rank
+# (category, viewer_dorm, ad_id, score), хендлер делает один range scan по
+# (category, viewer_dorm, score DESC, ad_id DESC) и листает keyset-курсором
+# "score:id".
+#
+#   score = created_at / RANK_RECENCY_HOURS
+#         + RANK_ENGAGEMENT_WEIGHT * ln(1 + views + 5*takes)
+#         + RANK_DORM_WEIGHT / (1 + |dorm - viewer_dorm|)
+#
+# Свежесть — абсолютное время, а не возраст, поэтому очки со временем не
+# «протухают»: пересчитывать нужно только новые объявления и те, у кого
+# поменялись просмотры/забирания (ads.engaged_at). Новая общага зрителя
+# считается целиком при следующем обновлении.
+
+RANK_LOCK_ID = 0x67766672  # "gvfr"
+# запас на транзакции счётчиков, которые стартовали до нашего снимка,
+# а закоммитились после
+RANK_OVERLAP = timedelta(seconds=60)
+
+_RANK_COLS = ", ".join(f"a.{c}" for c in AD_FEED_COLS.split(", ")) + ", r.score"
+
+Q_RANK_UPSERT = query(
+    "rank_upsert",
+    """
+    INSERT INTO feed_rank(category, viewer_dorm, ad_id, score)
+    SELECT
+        a.category,
+        v.dorm,
+        a.id,
+        round(1000000 * (
+            extract(epoch FROM a.created_at) / ($2::float8 * 3600)
+            + $3::float8 * ln(1 + a.views + 5 * a.takes)
+            + CASE WHEN a.dorm IS NULL THEN 0 ELSE $4::float8 / (1 + abs(a.dorm - v.dorm)) END
+        ))::bigint
+    FROM ads a
+    CROSS JOIN unnest($1::int[]) AS v(dorm)
+    WHERE a.approved=TRUE AND a.expires_at > NOW()
+      AND ($5::timestamptz IS NULL OR a.created_at >= $5 OR a.engaged_at >= $5)
+    ON CONFLICT (viewer_dorm, ad_id) DO UPDATE SET score=EXCLUDED.score
+    """,
+)
 
-    await call.bot.send_message(
-        seller_id,
-        "❤️ *Твоё объявление заинтересовало покупателя!*\n\n"
-        f"👤 {user_link_md(call.from_user.id, buyer_username, 'Покупатель')}\n"
-        f"📞 `{buyer_phone}`\n\n"
-        f"🆔 Объявление: `{ad_id}`",
-        reply_markup=kb_seller,
-        parse_mode="Markdown",
+# lower -> query
+Q_RANK_NEIGHBOUR = {
+    True: query(
+        "rank_lower",
+        f"""
+        SELECT {_RANK_COLS}
+        FROM feed_rank r JOIN ads a ON a.id = r.ad_id
+        WHERE r.category=$1 AND r.viewer_dorm=$2 AND (r.score, r.ad_id) < ($3, $4)
+          AND a.approved=TRUE AND a.expires_at > NOW()
+        ORDER BY r.score DESC, r.ad_id DESC
+        LIMIT 1
+        """,
+    ),
+    False: query(
+        "rank_higher",
+        f"""
+        SELECT {_RANK_COLS}
+        FROM feed_rank r JOIN ads a ON a.id = r.ad_id
+        WHERE r.category=$1 AND r.viewer_dorm=$2 AND (r.score, r.ad_id) > ($3, $4)
+          AND a.approved=TRUE AND a.expires_at > NOW()
+        ORDER BY r.score, r.ad_id
+        LIMIT 1
+        """,
+    ),
+}
+
+# bottom -> query
+Q_RANK_EDGE = {
+    True: query(
+        "rank_bottom",
+        f"""
+        SELECT {_RANK_COLS}
+        FROM feed_rank r JOIN ads a ON a.id = r.ad_id
+        WHERE r.category=$1 AND r.viewer_dorm=$2 AND a.approved=TRUE AND a.expires_at > NOW()
+        ORDER BY r.score, r.ad_id
+        LIMIT 1
+        """,
+    ),
+    False: query(
+        "rank_top",
+        f"""
+        SELECT {_RANK_COLS}
+        FROM feed_rank r JOIN ads a ON a.id = r.ad_id
+        WHERE r.category=$1 AND r.viewer_dorm=$2 AND a.approved=TRUE AND a.expires_at > NOW()
+        ORDER BY r.score DESC, r.ad_id DESC
+        LIMIT 1
+        """,
+    ),
+}
+
+
+async def rank_edge(cat: Category, dorm: int, bottom: bool) -> Optional[Ad]:
+    row = await db_fetchrow(Q_RANK_EDGE[bottom], cat.key, dorm)
+    return Ad.from_row(row) if row else None
+
+
+async def rank_neighbour(cat: Category, dorm: int, score: int, ad_id: int, lower: bool) -> Optional[Ad]:
+    row = await db_fetchrow(Q_RANK_NEIGHBOUR[lower], cat.key, dorm, score, ad_id)
+    if row:
+        return Ad.from_row(row)
+    return await rank_edge(cat, dorm, bottom=not lower)
+
+
+class FeedRanker:
+    def __init__(self) -> None:
+        self._dorms: set[int] = set()
+        self._since: Optional[datetime] = None
+
+    async def refresh(self) -> None:
+        weights = (RANK_RECENCY_HOURS, RANK_ENGAGEMENT_WEIGHT, RANK_DORM_WEIGHT)
+        async with db_acquire() as conn:
+            async with conn.transaction():
+                # несколько реплик — считает одна, остальные пропускают круг
+                if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", RANK_LOCK_ID):
+                    return
+                started = await conn.fetchval("SELECT NOW()")
+                rows = await conn.fetch("SELECT DISTINCT dorm FROM users WHERE dorm IS NOT NULL")
+                dorms = {r["dorm"] for r in rows}
+
+                new = dorms - self._dorms
+                if new:
+                    await _run(conn, Q_RANK_UPSERT, "fetch", (sorted(new), *weights, None))
+                known = dorms & self._dorms
+                if known and self._since is not None:
+                    await _run(conn, Q_RANK_UPSERT, "fetch", (sorted(known), *weights, self._since))
+
+        self._dorms = dorms
+        self._since = started - RANK_OVERLAP
+
+    async def refresher(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception("[rank] refresh failed")
+            await asyncio.sleep(RANK_REFRESH_SEC)
+
+
+ranker = FeedRanker()
+
+
+@router.callback_query(CategoryCallback("rprev", "rnext"), flags={"verified": True})
+async def rank_nav(call: CallbackQuery, cat: Category, action: str, payload: str, user: Optional[asyncpg.Record]):
+    dorm = user["dorm"] if user else None
+    try:
+        score, ad_id = map(int, payload.split(":"))
+    except ValueError:
+        score = ad_id = None
+
+    if dorm is None or ad_id is None:
+        # общагу забыли / старые кнопки — обычная лента
+        ad = await ad_edge(cat, oldest=False)
+        if not ad:
+            await call.answer("Пока нет объявлений", show_alert=True)
+            return
+        await show_ad_at(call, cat, ad)
+        await call.answer()
+        return
+
+    await navigator.navigate(
+        call,
+        1 if action == "rnext" else -1,
+        Ad(score=score, id=ad_id),
+        lambda ad, lower: rank_neighbour(cat, dorm, ad.score, ad.id, lower),
+        lambda ad: show_ad_at(call, cat, ad, nav="r"),
+        "Пока нет объявлений",
     )
 
-    await call.answer("Контакты отправлены")
 
 # ================= MY ADS =================
 
-def my_ad_ikb(ad_id: int) -> InlineKeyboardMarkup:
+@router.callback_query(F.data == "menu_my", flags={"verified": True, "tech": True})
+async def menu_my(call: CallbackQuery):
+    ad = await db_my_edge(call.from_user.id, oldest=False)
+
+    if not ad:
+        await call.message.edit_text(
+            "📭 *У тебя пока нет объявлений*",
+            reply_markup=back_menu_ikb(),
+            parse_mode="Markdown",
+        )
+        await call.answer()
+        return
+
+    await show_my_ad(call, ad)
+    await call.answer()
+
+
+# older -> query
+Q_MY_NEIGHBOUR = {
+    True: query(
+        "my_older",
+        f"""
+        SELECT {AD_MY_COLS} FROM ads
+        WHERE user_id=$1 AND (created_at, id) < ($2, $3)
+        ORDER BY created_at DESC, id DESC
+        LIMIT 1
+        """,
+    ),
+    False: query(
+        "my_newer",
+        f"""
+        SELECT {AD_MY_COLS} FROM ads
+        WHERE user_id=$1 AND (created_at, id) > ($2, $3)
+        ORDER BY created_at, id
+        LIMIT 1
+        """,
+    ),
+}
+
+# oldest -> query
+Q_MY_EDGE = {
+    True: query(
+        "my_oldest",
+        f"SELECT {AD_MY_COLS} FROM ads WHERE user_id=$1 ORDER BY created_at, id LIMIT 1",
+    ),
+    False: query(
+        "my_newest",
+        f"SELECT {AD_MY_COLS} FROM ads WHERE user_id=$1 ORDER BY created_at DESC, id DESC LIMIT 1",
+    ),
+}
+
+Q_MY_DELETE = query(
+    "my_delete",
+    "DELETE FROM ads WHERE id=$1 AND user_id=$2 RETURNING created_at",
+)
+
+
+async def db_my_edge(user_id: int, oldest: bool) -> Optional[Ad]:
+    row = await db_fetchrow(Q_MY_EDGE[oldest], user_id)
+    return Ad.from_row(row) if row else None
+
+
+async def db_my_neighbour(
+    user_id: int, created_at: datetime, ad_id: int, older: bool
+) -> Optional[Ad]:
+    # с переходом через край, как и в ленте
+    async with db_acquire() as conn:
+        row = await db_fetchrow(Q_MY_NEIGHBOUR[older], user_id, created_at, ad_id, conn=conn)
+        if row is None:
+            row = await db_fetchrow(Q_MY_EDGE[not older], user_id, conn=conn)
+    return Ad.from_row(row) if row else None
+
+
+def my_ad_ikb(ad: Ad) -> InlineKeyboardMarkup:
+    cursor = encode_cursor(ad.created_at, ad.id)
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="⬅️", callback_data="my_prev"),
-                InlineKeyboardButton(text="🗑 Удалить", callback_data=f"my_del:{ad_id}"),
-                InlineKeyboardButton(text="➡️", callback_data="my_next"),
+                InlineKeyboardButton(text="⬅️", callback_data=f"my_prev:{cursor}"),
+                InlineKeyboardButton(text="🗑 Удалить", callback_data=f"my_del:{ad.id}"),
+                InlineKeyboardButton(text="➡️", callback_data=f"my_next:{cursor}"),
             ],
             [InlineKeyboardButton(text=HOME_TEXT, callback_data="menu_home")],
         ]
     )
 
 
-def _fmt_my_ad(ad: asyncpg.Record, idx: int, total: int) -> str:
+def _fmt_left(expires_at: Optional[datetime]) -> str:
+    if expires_at is None:
+        return "∞"
+    left = expires_at - datetime.now(timezone.utc)
+    if left <= timedelta(0):
+        return "истекает"
+    if left < timedelta(hours=1):
+        return f"{left // timedelta(minutes=1)} мин"
+    if left < timedelta(days=2):
+        return f"{left // timedelta(hours=1)} ч"
+    return f"{left.days} дн"
+
+
+def _fmt_my_ad(ad: Ad) -> str:
+    # + ещё не сброшенные в базу показы/клики
+    views, takes = engagement.pending(ad.id)
+    cat = CATEGORIES.get(ad.category)
     return (
-        "📢 *Моё объявление*\n\n"
-        f"💰 Цена: *{ad['price']}*\n"
-        f"🏢 Общага: *{ad['dorm']}*\n"
-        f"📍 Место: *{ad['location']}*\n\n"
-        f"{ad['description'] or ''}\n\n"
-        f"_ {idx+1}/{total} _\n"
-        f"🆔 ID: `{ad['id']}`"
+        f"📢 *Моё объявление* · {cat.title if cat else ad.category}\n\n"
+        f"💰 Цена: *{ad.price}*\n"
+        f"🏢 Общага: *{ad.dorm}*\n"
+        + (f"📍 Место: *{ad.location}*\n" if ad.location else "")
+        + "\n"
+        f"{ad.description or ''}\n\n"
+        f"👁 {ad.views + views}  ❤️ {ad.takes + takes}  ⏳ {_fmt_left(ad.expires_at)}\n"
+        + ("" if ad.approved else "🧐 На модерации\n")
+        + f"🆔 ID: `{ad.id}`"
     )
 
 
-async def show_my_ad(call: CallbackQuery, ads: list[asyncpg.Record], idx: int):
-    idx = max(0, min(idx, len(ads) - 1))
-    _my_pos[call.from_user.id] = idx
-    ad = ads[idx]
-
-    caption = _fmt_my_ad(ad, idx, len(ads))
-    photo_id = ad.get("photo_file_id")
-    ad_id = int(ad["id"])
+async def show_my_ad(call: CallbackQuery, ad: Ad) -> bool:
+    caption = _fmt_my_ad(ad)
+    photo_id = ad.photo_file_id
 
     try:
         if call.message.photo and photo_id:
@@ -913,74 +3171,80 @@ async def show_my_ad(call: CallbackQuery, ads: list[asyncpg.Record], idx: int):
             )
             await call.message.edit_media(
                 media=media,
-                reply_markup=my_ad_ikb(ad_id),
+                reply_markup=my_ad_ikb(ad),
             )
-            return
+            return True
+        if not call.message.photo and not photo_id:
+            await call.message.edit_text(caption, parse_mode="Markdown", reply_markup=my_ad_ikb(ad))
+            return True
+    except TelegramBadRequest as e:
+        if "not modified" in str(e):
+            return True
+        swallowed("show_my_ad.edit")
     except Exception:
-        pass
+        swallowed("show_my_ad.edit")
 
     try:
         await call.message.delete()
     except Exception:
-        pass
+        swallowed("show_my_ad.delete")
 
     if photo_id:
         await call.message.answer_photo(
             photo=photo_id,
             caption=caption,
             parse_mode="Markdown",
-            reply_markup=my_ad_ikb(ad_id),
+            reply_markup=my_ad_ikb(ad),
         )
     else:
         await call.message.answer(
             caption,
             parse_mode="Markdown",
-            reply_markup=my_ad_ikb(ad_id),
+            reply_markup=my_ad_ikb(ad),
         )
+    return False
 
 
-@router.callback_query(F.data.in_({"my_prev", "my_next"}))
+@router.callback_query(F.data.startswith(("my_prev", "my_next")))
 async def my_ads_nav(call: CallbackQuery):
-    async with db_pool().acquire() as conn:
-        ads = await conn.fetch(
-            "SELECT * FROM ads WHERE user_id=$1 ORDER BY created_at DESC LIMIT 50",
-            call.from_user.id,
-        )
-
-    if not ads:
-        await call.answer("Объявлений нет", show_alert=True)
+    action, _, raw = call.data.partition(":")
+    cursor = decode_cursor(raw)
+    if cursor is None:
+        ad = await db_my_edge(call.from_user.id, oldest=False)
+        if not ad:
+            await call.answer("Объявлений нет", show_alert=True)
+            return
+        await show_my_ad(call, ad)
+        await call.answer()
         return
 
-    cur = _my_pos.get(call.from_user.id, 0)
-    cur = cur + 1 if call.data == "my_next" else cur - 1
-    cur %= len(ads)
-
-    await show_my_ad(call, ads, cur)
-    await call.answer()
+    user_id = call.from_user.id
+    await navigator.navigate(
+        call,
+        1 if action == "my_next" else -1,
+        Ad(created_at=cursor[0], id=cursor[1]),
+        lambda ad, older: db_my_neighbour(user_id, ad.created_at, ad.id, older),
+        lambda ad: show_my_ad(call, ad),
+        "Объявлений нет",
+    )
 
 
 @router.callback_query(F.data.startswith("my_del:"))
 async def my_ads_delete(call: CallbackQuery):
     ad_id = int(call.data.split(":")[1])
 
-    async with db_pool().acquire() as conn:
-        res = await conn.execute(
-            "DELETE FROM ads WHERE id=$1 AND user_id=$2",
-            ad_id,
-            call.from_user.id,
-        )
+    deleted = await db_fetchrow(Q_MY_DELETE, ad_id, call.from_user.id)
 
-    if not res.endswith("1"):
+    if not deleted:
         await call.answer("Не удалось удалить", show_alert=True)
         return
 
-    async with db_pool().acquire() as conn:
-        ads = await conn.fetch(
-            "SELECT * FROM ads WHERE user_id=$1 ORDER BY created_at DESC LIMIT 50",
-            call.from_user.id,
-        )
+    feed_remove(ad_id)
+
+    # показываем следующее (более старое) после удалённого
+    ad = await db_my_neighbour(call.from_user.id, deleted["created_at"], ad_id, older=True)
 
-    if not ads:
+    if not ad:
         await call.message.edit_text(
             "📭 Все объявления удалены",
             reply_markup=back_menu_ikb(),
@@ -988,18 +3252,542 @@ async def my_ads_delete(call: CallbackQuery):
         await call.answer()
         return
 
-    cur = min(_my_pos.get(call.from_user.id, 0), len(ads) - 1)
-    await show_my_ad(call, ads, cur)
+    await show_my_ad(call, ad)
     await call.answer("Удалено ✅")
 
+# ================= JANITOR =================
+# Объявления живут Category.ttl своей категории. Раз в JANITOR_SEC просроченные
+# удаляются пачками по JANITOR_BATCH (каждая пачка — отдельный короткий
+# DELETE, SKIP LOCKED — реплики не мешают друг другу), из горячей ленты
+# тоже, а продавцу уходит уведомление через outbound-очередь.
+# Вместе с объявлением каскадом уходит feed_rank; ad_stats_daily остаётся
+# (без внешнего ключа, см. миграцию 12) — это история.
+
+# о давно просроченных (например, после миграции) не пишем
+JANITOR_NOTIFY_WINDOW = timedelta(days=1)
+
+Q_ADS_EXPIRE = query(
+    "ads_expire",
+    """
+    DELETE FROM ads
+    WHERE id IN (
+        SELECT id FROM ads
+        WHERE expires_at <= NOW()
+        ORDER BY expires_at
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, user_id, description, expires_at
+    """,
+)
+
+
+async def expire_ads(bot: Bot) -> int:
+    total = 0
+    while True:
+        rows = await db_fetch(Q_ADS_EXPIRE, JANITOR_BATCH)
+        cutoff = datetime.now(timezone.utc) - JANITOR_NOTIFY_WINDOW
+        for r in rows:
+            feed_remove(r["id"])
+            if r["expires_at"] > cutoff:
+                spawn(
+                    send_later(
+                        bot,
+                        r["user_id"],
+                        f"⌛️ Объявление #{r['id']} снято — срок показа истёк.\n\n"
+                        f"{(r['description'] or '')[:200]}\n\n"
+                        "Если ещё актуально — опубликуй заново.",
+                    )
+                )
+        total += len(rows)
+        if len(rows) < JANITOR_BATCH:
+            return total
+        # между пачками отдаём пул живому трафику
+        await asyncio.sleep(0.1)
+
+
+Q_ACTION_KEYS_PURGE = query(
+    "action_keys_purge",
+    "DELETE FROM action_keys WHERE created_at < NOW() - $1::interval",
+)
+
+
+async def janitor(bot: Bot) -> None:
+    while True:
+        try:
+            n = await expire_ads(bot)
+            if n:
+                logging.info("[janitor] expired %s ads", n)
+            await db_fetch(Q_ACTION_KEYS_PURGE, timedelta(hours=ACTION_KEY_TTL_HOURS))
+        except Exception:
+            logging.exception("[janitor] expire failed")
+        await asyncio.sleep(JANITOR_SEC)
+
+
+# ================= OUTBOUND =================
+# Все исходящие запросы к Bot API проходят через OutboundScheduler
+# (request-middleware сессии aiogram):
+#   * сообщения в один чат уходят строго по очереди (FIFO-лок на чат);
+#   * лимит на чат: ~1/сек в личке, 20/мин в группах, с небольшим burst;
+#   * общий лимит TG_GLOBAL_RATE/сек, при этом интерактивные ответы
+#     обгоняют фоновый трафик (рассылки, уведомления админу);
+#   * на 429 ждём retry_after (ставим на паузу всех) и повторяем.
+# Методы без chat_id (getUpdates, answerCallbackQuery) идут мимо очереди.
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+_outbound_priority: ContextVar[int] = ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _take(self) -> float:
+        # 0 — токен взят, иначе сколько ждать до следующей попытки
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while (delay := self._take()) > 0:
+                await asyncio.sleep(delay)
+
+
+class PriorityTokenBucket(TokenBucket):
+    def __init__(self, rate: float, burst: float):
+        super().__init__(rate, burst)
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._pump: Optional[asyncio.Task] = None
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> None:
+        if not self._waiters and self._take() == 0:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.ensure_future(self._run())
+        await fut
+
+    async def _run(self) -> None:
+        while self._waiters:
+            if self._waiters[0][2].cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._take()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.cancelled():
+                self.tokens += 1
+            else:
+                fut.set_result(None)
+
+
+class _ChatLane:
+    __slots__ = ("lock", "bucket", "refs")
+
+    def __init__(self, chat_id: Any):
+        self.lock = asyncio.Lock()
+        group = not isinstance(chat_id, int) or chat_id < 0
+        self.bucket = TokenBucket(20 / 60, 3) if group else TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+        self.refs = 0
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self, rate: float, max_retries: int = 3):
+        self.bucket = PriorityTokenBucket(rate, rate)
+        self.max_retries = max_retries
+        self._lanes: dict[Any, _ChatLane] = {}
+
+    async def __call__(self, make_request: Any, bot: Bot, method: Any) -> Any:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = _ChatLane(chat_id)
+        lane.refs += 1
+        try:
+            async with lane.lock:
+                priority = _outbound_priority.get()
+                attempt = 0
+                while True:
+                    await lane.bucket.acquire()
+                    await self.bucket.acquire(priority)
+                    try:
+                        return await make_request(bot, method)
+                    except TelegramRetryAfter as e:
+                        attempt += 1
+                        if attempt > self.max_retries:
+                            raise
+                        logging.warning(
+                            "[outbound] 429 on %s, retry after %ss",
+                            type(method).__name__,
+                            e.retry_after,
+                        )
+                        self.bucket.pause(e.retry_after)
+                        lane.bucket.pause(e.retry_after)
+        finally:
+            lane.refs -= 1
+            if lane.refs == 0:
+                self._lanes.pop(chat_id, None)
+
+
+outbound = OutboundScheduler(TG_GLOBAL_RATE)
+gauge("gvf_outbound_lanes", "Chats with queued outbound requests", lambda: len(outbound._lanes))
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    # регистрируется после outbound — то есть ближе к сети и видит каждую попытку
+    async def __call__(self, make_request: Any, bot: Bot, method: Any) -> Any:
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            _tg_errors.inc(name, "retry_after")
+            raise
+        except TelegramForbiddenError:
+            _tg_errors.inc(name, "forbidden")
+            raise
+        except TelegramBadRequest:
+            _tg_errors.inc(name, "bad_request")
+            raise
+        except Exception:
+            _tg_errors.inc(name, "other")
+            raise
+        finally:
+            _tg_seconds.observe(time.perf_counter() - started, name)
+
+
+async def send_later(
+    bot: Bot, chat_id: int, text: str, priority: int = PRIORITY_BULK, **kwargs: Any
+) -> None:
+    # фоновое уведомление (запускать через spawn): хендлер не ждёт отправку,
+    # а ошибки (например, бот заблокирован) уходят только в лог
+    token = _outbound_priority.set(priority)
+    try:
+        await bot.send_message(chat_id, text, **kwargs)
+    except Exception:
+        logging.warning("[outbound] message to %s failed", chat_id, exc_info=True)
+    finally:
+        _outbound_priority.reset(token)
+
+
+# ================= BROADCAST =================
+# Рассылка — фоновая задача. Задание и статус каждого получателя лежат в
+# Postgres, так что после рестарта она продолжается с места остановки.
+# Процесс «арендует» задание (lease_until) и продлевает аренду каждые
+# BROADCAST_LEASE_SEC/3, пока рассылка идёт (медленная пачка не отдаст её
+# другой реплике — иначе дубли сообщений); просроченную аренду подхватывает
+# broadcast_resumer любой реплики, кроме заданий, уже идущих в этом процессе.
+# Отправка: не больше BROADCAST_CONCURRENCY параллельно и не быстрее
+# BROADCAST_RATE сообщений/сек на процесс; retry_after ставит на паузу всех.
+
+_broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+
+BROADCAST_MAX_ATTEMPTS = 5
+
+# id рассылок, которые крутит этот процесс
+_broadcasts_running: set[int] = set()
+
+
+async def db_create_broadcast(admin_id: int, text: str) -> asyncpg.Record:
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            job = await conn.fetchrow(
+                """
+                INSERT INTO broadcasts(admin_id, text, lease_until)
+                VALUES($1, $2, NOW() + make_interval(secs => $3))
+                RETURNING id
+                """,
+                admin_id,
+                text,
+                BROADCAST_LEASE_SEC,
+            )
+            await conn.execute(
+                """
+                INSERT INTO broadcast_recipients(broadcast_id, user_id)
+                SELECT $1, user_id FROM users WHERE is_verified AND NOT is_blocked
+                """,
+                job["id"],
+            )
+            return await conn.fetchrow(
+                """
+                UPDATE broadcasts
+                SET total=(SELECT COUNT(*) FROM broadcast_recipients WHERE broadcast_id=$1)
+                WHERE id=$1
+                RETURNING *
+                """,
+                job["id"],
+            )
+
+
+async def db_set_broadcast_progress_message(job_id: int, chat_id: int, message_id: int) -> None:
+    async with db_acquire() as conn:
+        await conn.execute(
+            "UPDATE broadcasts SET progress_chat_id=$2, progress_message_id=$3 WHERE id=$1",
+            job_id,
+            chat_id,
+            message_id,
+        )
+
+
+async def db_claim_broadcast(job_id: int, force: bool = False) -> Optional[asyncpg.Record]:
+    # force — задание только что создано этим же процессом, аренда уже наша
+    async with db_acquire() as conn:
+        return await conn.fetchrow(
+            """
+            UPDATE broadcasts
+            SET lease_until=NOW() + make_interval(secs => $2)
+            WHERE id=$1 AND status='running'
+              AND ($3 OR lease_until IS NULL OR lease_until < NOW())
+            RETURNING *
+            """,
+            job_id,
+            BROADCAST_LEASE_SEC,
+            force,
+        )
+
+
+async def db_renew_broadcast(job_id: int) -> None:
+    async with db_acquire() as conn:
+        await conn.execute(
+            """
+            UPDATE broadcasts
+            SET lease_until=NOW() + make_interval(secs => $2)
+            WHERE id=$1 AND status='running'
+            """,
+            job_id,
+            BROADCAST_LEASE_SEC,
+        )
+
+
+async def db_broadcast_pending(job_id: int, limit: int) -> list[int]:
+    async with db_acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT user_id FROM broadcast_recipients
+            WHERE broadcast_id=$1 AND status='pending'
+            ORDER BY user_id
+            LIMIT $2
+            """,
+            job_id,
+            limit,
+        )
+    return [r["user_id"] for r in rows]
+
+
+async def db_broadcast_record(
+    job_id: int, results: list[tuple[int, str, Optional[str]]]
+) -> asyncpg.Record:
+    # одна транзакция на пачку: статусы получателей, счётчики, блокировки, аренда
+    user_ids = [r[0] for r in results]
+    statuses = [r[1] for r in results]
+    errors = [r[2] for r in results]
+    blocked = [uid for uid, st, _ in results if st == "blocked"]
+
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                UPDATE broadcast_recipients r
+                SET status=v.status, error=v.error
+                FROM unnest($2::bigint[], $3::text[], $4::text[]) AS v(user_id, status, error)
+                WHERE r.broadcast_id=$1 AND r.user_id=v.user_id
+                """,
+                job_id,
+                user_ids,
+                statuses,
+                errors,
+            )
+            if blocked:
+                await conn.execute(
+                    "UPDATE users SET is_blocked=TRUE WHERE user_id = ANY($1::bigint[])",
+                    blocked,
+                )
+            job = await conn.fetchrow(
+                """
+                UPDATE broadcasts
+                SET sent=sent+$2, failed=failed+$3, blocked=blocked+$4,
+                    lease_until=NOW() + make_interval(secs => $5)
+                WHERE id=$1
+                RETURNING *
+                """,
+                job_id,
+                statuses.count("sent"),
+                statuses.count("failed"),
+                len(blocked),
+                BROADCAST_LEASE_SEC,
+            )
+
+    for uid in blocked:
+        _user_cache.evict(uid)
+    return job
+
+
+async def db_finish_broadcast(job_id: int) -> asyncpg.Record:
+    async with db_acquire() as conn:
+        return await conn.fetchrow(
+            """
+            UPDATE broadcasts
+            SET status='done', finished_at=NOW(), lease_until=NULL
+            WHERE id=$1
+            RETURNING *
+            """,
+            job_id,
+        )
+
+
+def _fmt_broadcast(job: asyncpg.Record) -> str:
+    done = job["sent"] + job["failed"] + job["blocked"]
+    head = "📣 Рассылка отправлена" if job["status"] == "done" else "📣 Рассылка идёт…"
+    return (
+        f"{head} #{job['id']}\n\n"
+        f"{done}/{job['total']}\n"
+        f"✅ {job['sent']}  🚫 {job['blocked']}  ⚠️ {job['failed']}"
+    )
+
+
+async def _broadcast_progress(bot: Bot, job: asyncpg.Record) -> None:
+    if not job["progress_chat_id"]:
+        return
+    try:
+        await bot.edit_message_text(
+            _fmt_broadcast(job),
+            chat_id=job["progress_chat_id"],
+            message_id=job["progress_message_id"],
+            reply_markup=admin_panel_ikb(),
+        )
+    except Exception:
+        swallowed("broadcast.progress")
+
+
+async def _broadcast_deliver(
+    bot: Bot, text: str, user_id: int, sem: asyncio.Semaphore
+) -> tuple[int, str, Optional[str]]:
+    async with sem:
+        for _ in range(BROADCAST_MAX_ATTEMPTS):
+            await _broadcast_bucket.acquire()
+            try:
+                await bot.send_message(user_id, text)
+                return user_id, "sent", None
+            except TelegramRetryAfter as e:
+                _broadcast_bucket.pause(e.retry_after)
+            except TelegramForbiddenError as e:
+                return user_id, "blocked", e.message[:200]
+            except Exception as e:
+                return user_id, "failed", str(e)[:200]
+        return user_id, "failed", "retry_after attempts exhausted"
+
+
+async def _broadcast_heartbeat(job_id: int) -> None:
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE_SEC / 3)
+        try:
+            await db_renew_broadcast(job_id)
+        except Exception:
+            logging.exception("[broadcast] #%s lease renewal failed", job_id)
+
+
+async def run_broadcast(bot: Bot, job_id: int, force: bool = True) -> None:
+    if job_id in _broadcasts_running:
+        return
+    _broadcasts_running.add(job_id)
+    try:
+        await _run_broadcast(bot, job_id, force)
+    finally:
+        _broadcasts_running.discard(job_id)
+
+
+async def _run_broadcast(bot: Bot, job_id: int, force: bool) -> None:
+    job = await db_claim_broadcast(job_id, force=force)
+    if not job:
+        return
+
+    # своя копия контекста у задачи — приоритет не утечёт в хендлеры
+    _outbound_priority.set(PRIORITY_BULK)
+
+    done = job["sent"] + job["failed"] + job["blocked"]
+    logging.info("[broadcast] #%s started at %s/%s", job_id, done, job["total"])
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    heartbeat = spawn(_broadcast_heartbeat(job_id))
+    try:
+        while True:
+            user_ids = await db_broadcast_pending(job_id, BROADCAST_BATCH)
+            if not user_ids:
+                break
+            results = await asyncio.gather(
+                *(_broadcast_deliver(bot, job["text"], uid, sem) for uid in user_ids)
+            )
+            job = await db_broadcast_record(job_id, results)
+            await _broadcast_progress(bot, job)
+
+        job = await db_finish_broadcast(job_id)
+        await _broadcast_progress(bot, job)
+        logging.info(
+            "[broadcast] #%s done: %s sent, %s blocked, %s failed",
+            job_id,
+            job["sent"],
+            job["blocked"],
+            job["failed"],
+        )
+    except Exception:
+        # аренда истечёт, и задание подхватит broadcast_resumer
+        logging.exception("[broadcast] #%s interrupted", job_id)
+    finally:
+        heartbeat.cancel()
+
+
+async def broadcast_resumer(bot: Bot) -> None:
+    while True:
+        try:
+            async with db_acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT id FROM broadcasts
+                    WHERE status='running' AND (lease_until IS NULL OR lease_until < NOW())
+                    """
+                )
+            for r in rows:
+                if r["id"] not in _broadcasts_running:
+                    spawn(run_broadcast(bot, r["id"], force=False))
+        except Exception:
+            logging.exception("[broadcast] resume check failed")
+        await asyncio.sleep(BROADCAST_LEASE_SEC / 2)
+
+
 # ================= ADMIN =================
 
 def admin_panel_ikb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
+            [InlineKeyboardButton(text="📋 Модерация", callback_data="admin_review")],
             [InlineKeyboardButton(text="🗑 Удалить объявление", callback_data="admin_del")],
             [InlineKeyboardButton(text="📣 Рассылка", callback_data="admin_broadcast")],
             [InlineKeyboardButton(text="🛠 Техработы", callback_data="admin_tech")],
+            [InlineKeyboardButton(text="🧐 Премодерация", callback_data="admin_premod")],
             [InlineKeyboardButton(text=HOME_TEXT, callback_data="menu_home")],
         ]
     )
@@ -1024,8 +3812,7 @@ async def admin_tech(call: CallbackQuery):
     if call.from_user.id != ADMIN_ID:
         return
 
-    current = await db_is_tech_mode()
-    new_state = not current
+    new_state = not is_tech_mode()
     await db_set_tech_mode(new_state)
 
     await call.message.edit_text(
@@ -1062,6 +3849,54 @@ async def admin_del_id(message: Message, state: FSMContext):
     await message.answer("✅ Удалено" if ok else "❌ Не найдено", reply_markup=admin_panel_ikb())
 
 
+def _fmt_stats() -> str:
+    ms = lambda sec: f"{sec * 1000:.0f}"
+    lines = ["📊 Статистика", "", "Хендлеры (p50 / p95 мс, вызовов):"]
+    handlers = sorted(_handler_seconds.counts, key=lambda h: -_handler_seconds.quantile(0.95, h))
+    for h in handlers[:10]:
+        errors = _handler_errors.values.get((h,), 0)
+        lines.append(
+            f"  {h}: {ms(_handler_seconds.quantile(0.5, h))} / {ms(_handler_seconds.quantile(0.95, h))}, "
+            f"{_handler_seconds.count(h)}" + (f", ошибок {errors}" if errors else "")
+        )
+
+    lines += ["", "Запросы БД (всего мс, p95 мс, вызовов):"]
+    queries = sorted(_db_query_seconds.sums.items(), key=lambda kv: -kv[1])
+    for q, total in queries[:5]:
+        lines.append(f"  {q}: {ms(total)}, {ms(_db_query_seconds.quantile(0.95, q))}, {_db_query_seconds.count(q)}")
+
+    tg_calls = sum(_tg_seconds.count(m) for m in _tg_seconds.counts)
+    lines += ["", f"Telegram: {tg_calls} запросов"]
+    for (method, kind), n in sorted(_tg_errors.values.items(), key=lambda kv: -kv[1]):
+        lines.append(f"  {method} {kind}: {n}")
+
+    c = user_cache_stats()
+    lines += ["", f"Кэш юзеров: {c['size']}, hit {c['hits']} / miss {c['misses']}, evict {c['evictions']}"]
+    try:
+        ps = pool_stats()
+        lines.append(
+            f"Пул БД: {ps['size']}/{ps['max']} (idle {ps['idle']}), "
+            f"ожидание avg {ps['wait_avg_ms']:.1f} мс, p95 {ps['wait_p95_ms']:.0f} мс"
+        )
+    except RuntimeError:
+        pass
+
+    if _swallowed.values:
+        lines += ["", "Проглоченные ошибки:"]
+        for (site,), n in sorted(_swallowed.values.items(), key=lambda kv: -kv[1]):
+            lines.append(f"  {site}: {n}")
+    return "\n".join(lines)
+
+
+@router.message(Command("stats"))
+async def admin_stats(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("⛔️ Нет доступа")
+        return
+
+    await message.answer(_fmt_stats())
+
+
 @router.callback_query(F.data == "admin_broadcast")
 async def admin_broadcast(call: CallbackQuery, state: FSMContext):
     if call.from_user.id != ADMIN_ID:
@@ -1087,22 +3922,21 @@ async def admin_broadcast_text(message: Message, state: FSMContext):
 
 
 
-@router.callback_query(F.data == "admin_send")
+@router.callback_query(F.data == "admin_send", flags={"lock": True})
 async def admin_send(call: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     if not data.get("text"):
         await call.answer("Текст рассылки пуст", show_alert=True)
         return
-    users = await db_list_verified_users()
-
-    for u in users:
-        try:
-            await call.bot.send_message(u["user_id"], data["text"])
-        except Exception:
-            pass
 
+    job = await db_create_broadcast(call.from_user.id, data["text"])
     await state.clear()
-    await call.message.answer("📣 Рассылка отправлена", reply_markup=admin_panel_ikb())
+
+    progress = await call.message.answer(_fmt_broadcast(job), reply_markup=admin_panel_ikb())
+    await db_set_broadcast_progress_message(job["id"], progress.chat.id, progress.message_id)
+
+    spawn(run_broadcast(call.bot, job["id"]))
+    await call.answer("Рассылка запущена")
 
 
 @router.callback_query(F.data == "admin_cancel")
@@ -1112,15 +3946,491 @@ async def admin_cancel(call: CallbackQuery, state: FSMContext):
 
 
 
+# ================= MODERATION =================
+# Премодерация (setting "premod", кнопка в админке): новые объявления
+# ложатся с approved=FALSE и не видны в лентах, поиске и рейтинге, пока
+# админ их не одобрит. Очередь листается страницами по REVIEW_PAGE
+# (keyset по (created_at, id), старые сверху); id видимой страницы лежат
+# в данных FSM админа, и «✅ Все» / «❌ Все» — один UPDATE / DELETE по
+# ANY($1). Вместо уведомления на каждое объявление админу раз в
+# REVIEW_DIGEST_SEC приходит сводка; отметку «с какого момента» храним в
+# settings, чтобы реплики и рестарты не слали её повторно.
+
+REVIEW_DIGEST_LOCK_ID = 0x67766664  # "gvfd"
+
+Q_REVIEW_PAGE = query(
+    "review_page",
+    """
+    SELECT a.id, a.category, a.user_id, a.price, a.dorm, a.location, a.description, a.created_at,
+           u.username
+    FROM ads a
+    LEFT JOIN users u ON u.user_id = a.user_id
+    WHERE NOT a.approved AND (a.created_at, a.id) > ($1, $2)
+    ORDER BY a.created_at, a.id
+    LIMIT $3
+    """,
+)
+
+Q_REVIEW_COUNT = query("review_count", "SELECT count(*) FROM ads WHERE NOT approved")
+
+# одобренное объявление — свежее: время и срок жизни считаются от одобрения
+Q_REVIEW_APPROVE = query(
+    "review_approve",
+    f"""
+    UPDATE ads
+    SET approved = TRUE,
+        approved_at = NOW(),
+        created_at = NOW(),
+        expires_at = NOW() + (expires_at - created_at)
+    WHERE id = ANY($1::bigint[]) AND NOT approved
+    RETURNING {AD_FEED_COLS}, category
+    """,
+)
+
+Q_REVIEW_REJECT = query(
+    "review_reject",
+    """
+    DELETE FROM ads
+    WHERE id = ANY($1::bigint[]) AND NOT approved
+    RETURNING id, user_id, description
+    """,
+)
+
+
+def is_premod() -> bool:
+    return setting("premod") == "true"
+
+
+async def db_review_page(after: Optional[tuple[datetime, int]]) -> tuple[list[asyncpg.Record], bool]:
+    created_at, ad_id = after or (_EPOCH, 0)
+    rows = await db_fetch(Q_REVIEW_PAGE, created_at, ad_id, REVIEW_PAGE + 1)
+    return rows[:REVIEW_PAGE], len(rows) > REVIEW_PAGE
+
+
+async def db_review_approve(bot: Bot, ids: list[int]) -> int:
+    rows = await db_fetch(Q_REVIEW_APPROVE, ids)
+    for r in rows:
+        cat = CATEGORIES.get(r["category"])
+        if cat is not None:
+            cat.feed.add(Ad.from_row(r))
+        spawn(send_later(bot, r["user_id"], f"✅ Объявление #{r['id']} прошло модерацию и опубликовано."))
+    return len(rows)
+
+
+async def db_review_reject(bot: Bot, ids: list[int]) -> int:
+    rows = await db_fetch(Q_REVIEW_REJECT, ids)
+    for r in rows:
+        spawn(
+            send_later(
+                bot,
+                r["user_id"],
+                f"🚫 Объявление #{r['id']} не прошло модерацию.\n\n{(r['description'] or '')[:200]}",
+            )
+        )
+    return len(rows)
+
+
+def _fmt_review(rows: list[asyncpg.Record], total: int) -> str:
+    # без Markdown: описания пользовательские, одна кривая звёздочка
+    # сломала бы всю страницу
+    if not rows:
+        return "🧐 Очередь модерации пуста"
+    lines = [f"🧐 На модерации: {total}", ""]
+    for r in rows:
+        cat = CATEGORIES.get(r["category"])
+        who = f"@{r['username']}" if r["username"] else f"id {r['user_id']}"
+        lines.append(
+            f"#{r['id']} · {cat.title if cat else r['category']} · {r['price']} · общага {r['dorm']} · {who}"
+        )
+        if r["location"]:
+            lines.append(f"📍 {r['location']}")
+        lines.append((r["description"] or "")[:300])
+        lines.append("")
+    return "\n".join(lines)
+
+
+def review_ikb(rows: list[asyncpg.Record], more: bool, paged: bool) -> InlineKeyboardMarkup:
+    kb = [
+        [
+            InlineKeyboardButton(text=f"✅ #{r['id']}", callback_data=f"review_ok:{r['id']}"),
+            InlineKeyboardButton(text=f"❌ #{r['id']}", callback_data=f"review_no:{r['id']}"),
+        ]
+        for r in rows
+    ]
+    if rows:
+        kb.append(
+            [
+                InlineKeyboardButton(text=f"✅ Все ({len(rows)})", callback_data="review_ok_all"),
+                InlineKeyboardButton(text=f"❌ Все ({len(rows)})", callback_data="review_no_all"),
+            ]
+        )
+    nav = []
+    if paged:
+        nav.append(InlineKeyboardButton(text="⏮ В начало", callback_data="admin_review"))
+    nav.append(InlineKeyboardButton(text="🔄", callback_data="review_reload"))
+    if more:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data="review_next"))
+    kb.append(nav)
+    kb.append([InlineKeyboardButton(text="⬅️ Админка", callback_data="admin_home")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+
+async def show_review(call: CallbackQuery, state: FSMContext, after: Optional[str]) -> None:
+    # after — курсор последнего объявления предыдущей страницы ("" — с начала)
+    rows, more = await db_review_page(decode_cursor(after) if after else None)
+    total = await db_fetchval(Q_REVIEW_COUNT)
+    await state.update_data(
+        review_after=after or "",
+        review_ids=[r["id"] for r in rows],
+        review_next=encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if rows else "",
+    )
+    try:
+        await call.message.edit_text(_fmt_review(rows, total), reply_markup=review_ikb(rows, more, bool(after)))
+    except TelegramBadRequest:
+        # «message is not modified» после 🔄 без изменений
+        swallowed("show_review.edit")
+
+
+@router.callback_query(F.data == "admin_premod")
+async def admin_premod(call: CallbackQuery):
+    if call.from_user.id != ADMIN_ID:
+        return
+
+    new_state = not is_premod()
+    await db_set_setting("premod", "true" if new_state else "false")
+
+    await call.message.edit_text(
+        f"🧐 Премодерация: *{'ВКЛ' if new_state else 'ВЫКЛ'}*",
+        reply_markup=admin_panel_ikb(),
+        parse_mode="Markdown",
+    )
+    await call.answer()
+
+
+@router.callback_query(F.data == "admin_review")
+async def admin_review(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        return
+
+    await show_review(call, state, None)
+    await call.answer()
+
+
+@router.callback_query(F.data.in_({"review_next", "review_reload"}))
+async def review_nav(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        return
+
+    data = await state.get_data()
+    key = "review_next" if call.data == "review_next" else "review_after"
+    await show_review(call, state, data.get(key))
+    await call.answer()
+
+
+@router.callback_query(F.data.startswith(("review_ok", "review_no")), flags={"lock": True})
+async def review_decide(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id != ADMIN_ID:
+        return
+
+    action, _, raw = call.data.partition(":")
+    data = await state.get_data()
+    if action.endswith("_all"):
+        ids = data.get("review_ids") or []
+    else:
+        ids = [int(raw)]
+
+    if action.startswith("review_ok"):
+        n = await db_review_approve(call.bot, ids)
+        await call.answer(f"Одобрено: {n}")
+    else:
+        n = await db_review_reject(call.bot, ids)
+        await call.answer(f"Отклонено: {n}")
+
+    # после «Все» страница пустеет — следующая подтянется с того же места
+    await show_review(call, state, data.get("review_after"))
+
+
+@router.callback_query(F.data == "admin_home")
+async def admin_home(call: CallbackQuery):
+    if call.from_user.id != ADMIN_ID:
+        return
+
+    await call.message.edit_text("🛡 *Админ-панель*", reply_markup=admin_panel_ikb(), parse_mode="Markdown")
+    await call.answer()
+
+
+async def db_review_digest() -> Optional[tuple[str, int]]:
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            # несколько реплик — сводку шлёт одна
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", REVIEW_DIGEST_LOCK_ID):
+                return None
+            now = await conn.fetchval("SELECT NOW()")
+            raw = await conn.fetchval("SELECT value FROM settings WHERE key='review_digest_at'")
+            since = datetime.fromisoformat(raw) if raw else now - timedelta(seconds=REVIEW_DIGEST_SEC)
+            # опубликованные — по approved_at: одобрение переписывает created_at,
+            # и объявление, ушедшее в сводку как «на модерацию», иначе
+            # посчиталось бы ещё раз
+            rows = await conn.fetch(
+                """
+                SELECT category, TRUE AS approved, count(*) AS n
+                FROM ads
+                WHERE approved_at > $1 AND approved_at <= $2
+                GROUP BY category
+                UNION ALL
+                SELECT category, FALSE, count(*)
+                FROM ads
+                WHERE NOT approved AND created_at > $1 AND created_at <= $2
+                GROUP BY category
+                """,
+                since,
+                now,
+            )
+            pending = await conn.fetchval("SELECT count(*) FROM ads WHERE NOT approved")
+            await conn.execute(
+                """
+                INSERT INTO settings(key, value) VALUES('review_digest_at', $1)
+                ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value
+                """,
+                now.isoformat(),
+            )
+
+    if not rows:
+        return None
+
+    published: dict[str, int] = {}
+    new_pending = 0
+    for r in rows:
+        if r["approved"]:
+            published[r["category"]] = r["n"]
+        else:
+            new_pending += r["n"]
+
+    lines = ["🧾 Новые объявления"]
+    for key, n in published.items():
+        cat = CATEGORIES.get(key)
+        lines.append(f"{cat.title if cat else key}: {n}")
+    if new_pending:
+        lines.append(f"🧐 На модерацию: +{new_pending}")
+    if pending:
+        lines.append(f"\nВ очереди всего: {pending}")
+    return "\n".join(lines), pending
+
+
+async def review_digester(bot: Bot) -> None:
+    while True:
+        await asyncio.sleep(REVIEW_DIGEST_SEC)
+        if not ADMIN_ID:
+            continue
+        try:
+            digest = await db_review_digest()
+        except Exception:
+            logging.exception("[review] digest failed")
+            continue
+        if digest is None:
+            continue
+        text, pending = digest
+        kb = None
+        if pending:
+            kb = InlineKeyboardMarkup(
+                inline_keyboard=[[InlineKeyboardButton(text="📋 Открыть очередь", callback_data="admin_review")]]
+            )
+        spawn(send_later(bot, ADMIN_ID, text, reply_markup=kb))
+
+
+# ================= UPDATE RECORDER =================
+# UPDATE_RECORD_PATH включает запись всех входящих апдейтов в gzip JSONL
+# ({"t": unix-время прихода, "update": {...}}) — потом их прогоняет
+# `bench.py replay`. В файле номера и юзернеймы: не коммитить, не пересылать.
+
+class UpdateRecorder(BaseMiddleware):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.recorded = 0
+        self._lines: list[str] = []
+        self._lock = asyncio.Lock()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        # сериализуем сразу, а пишем пачкой из flusher() в отдельном потоке
+        self._lines.append(json.dumps(
+            {"t": time.time(), "update": event.model_dump(mode="json", exclude_none=True, by_alias=True)},
+            ensure_ascii=False,
+        ))
+        return await handler(event, data)
+
+    def _write(self, lines: list[str]) -> None:
+        # "at" дописывает новый gzip-member, gzip.open читает их подряд
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._lines:
+                return
+            lines, self._lines = self._lines, []
+            await asyncio.to_thread(self._write, lines)
+            self.recorded += len(lines)
+
+    async def flusher(self) -> None:
+        while True:
+            await asyncio.sleep(UPDATE_RECORD_FLUSH_SEC)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("[record] flush failed")
+
+
+recorder = UpdateRecorder(UPDATE_RECORD_PATH) if UPDATE_RECORD_PATH else None
+
+
+# ================= WEBHOOK =================
+# BOT_MODE=webhook: встроенный aiohttp-сервер.
+#   POST WEBHOOK_PATH — проверяем секрет, кладём апдейт в очередь и сразу
+#     отвечаем 200; обработкой занимаются WEBHOOK_WORKERS воркеров.
+#     Очередь переполнена — 503, Telegram повторит доставку позже.
+#   GET /healthz — процесс жив; GET /readyz — пул БД отвечает.
+# Без WEBHOOK_URL вебхук в Telegram не регистрируется — удобно гонять
+# локально: curl -XPOST localhost:8080/webhook -d @update.json
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+
+async def metrics_server() -> None:
+    # /metrics — только на своём порту, не рядом с публичным вебхуком
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, METRICS_PORT).start()
+    logging.info("[metrics] listening on %s:%s/metrics", WEBHOOK_HOST, METRICS_PORT)
+
+
+class WebhookServer:
+    def __init__(self, bot: Bot, dp: Dispatcher):
+        self.bot = bot
+        self.dp = dp
+        self.queue: asyncio.Queue[Update] = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        gauge("gvf_webhook_queue", "Updates waiting for a worker", self.queue.qsize)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/readyz", self.handle_ready)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logging.warning("[webhook] queue full, update %s rejected", update.update_id)
+            return web.Response(status=503)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"ok": True, "version": APP_VERSION, "queue": self.queue.qsize()})
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        try:
+            async with db_acquire(timeout=2) as conn:
+                await conn.fetchval("SELECT 1")
+        except Exception as e:
+            return web.json_response({"ok": False, "db": str(e)}, status=503)
+        return web.json_response({"ok": True, "queue": self.queue.qsize()})
+
+    async def worker(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                logging.exception("[webhook] update %s failed", update.update_id)
+            finally:
+                self.queue.task_done()
+
+    async def run(self) -> None:
+        workflow = {"bots": [self.bot], "dispatcher": self.dp, **self.dp.workflow_data}
+        await self.dp.emit_startup(bot=self.bot, **workflow)
+
+        workers = [spawn(self.worker()) for _ in range(WEBHOOK_WORKERS)]
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            logging.info("[webhook] listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+            if WEBHOOK_URL:
+                await self.bot.set_webhook(
+                    WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=self.dp.resolve_used_update_types(),
+                )
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            # дорабатываем то, что уже приняли
+            await self.queue.join()
+            for w in workers:
+                w.cancel()
+            await self.dp.emit_shutdown(bot=self.bot, **workflow)
+            await self.bot.session.close()
+
+
 # ================= RUN =================
 
-async def main():
-    bot = Bot(BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+# create_dispatcher/start_background общие для main() и bench.py
+
+def create_dispatcher(bot: Bot) -> Dispatcher:
+    bot.session.middleware(outbound)
+    bot.session.middleware(TelegramMetricsMiddleware())
+    dp = Dispatcher(storage=fsm_storage)
     dp.include_router(router)
+    dp.shutdown.register(engagement.flush)
+    if recorder is not None:
+        dp.update.outer_middleware(recorder)
+        dp.shutdown.register(recorder.flush)
+        logging.info("[record] writing updates to %s", recorder.path)
+    return dp
+
 
+async def start_background(bot: Bot, dp: Dispatcher) -> None:
     await db_init()
-    await dp.start_polling(bot)
+    await feed_reload()
+    spawn(settings_listener())
+    spawn(dp.storage.flusher())
+    spawn(engagement.flusher())
+    spawn(feed_reconciler())
+    spawn(ranker.refresher())
+    spawn(janitor(bot))
+    spawn(review_digester(bot))
+    spawn(broadcast_resumer(bot))
+    if recorder is not None:
+        spawn(recorder.flusher())
+
+
+async def main():
+    bot = Bot(BOT_TOKEN)
+    dp = create_dispatcher(bot)
+    await start_background(bot, dp)
+    if METRICS_PORT:
+        await metrics_server()
+    if BOT_MODE == "webhook":
+        await WebhookServer(bot, dp).run()
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":